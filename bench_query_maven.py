@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmark the decoding of recorded Maven Central responses by :class:`query_maven.ResponseWrapper`.
+
+Record a response with e.g.
+``curl -o resp.json 'http://search.maven.org/solrsearch/select?q=g:org.apache*&rows=2048&wt=json'`` and pass its
+path; without any paths, a synthetic response is generated instead.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from datetime import timedelta
+
+import query_maven
+
+
+class RecordedResponse(object):
+    """
+    Stands in for a :class:`requests.Response` whose body was recorded to a file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.elapsed = timedelta(0)
+
+    def json(self):
+        with open(self.path, "rb") as f:
+            return json.load(f)
+
+    def iter_content(self, chunk_size=1):
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                yield chunk
+
+
+def synthesize_response(num_docs):
+    """
+    Write a synthetic Solr response with ``num_docs`` docs to a temporary file and return its path.
+    """
+    docs = [{"id": "org.example.g{0}:artifact{1}:1.{2}".format(i % 97, i % 1013, i),
+             "g": "org.example.g{0}".format(i % 97), "a": "artifact{0}".format(i % 1013), "v": "1.{0}".format(i),
+             "p": "jar", "timestamp": 1400000000000 + i * 7919 % 100000000, "tags": ["example", "synthetic"],
+             "ec": ["-sources.jar", ".pom", ".jar", "-javadoc.jar"]} for i in xrange(num_docs)]
+    payload = {"responseHeader": {"status": 0, "QTime": 12, "params": {"q": "g:org.example*"}},
+               "response": {"numFound": num_docs, "start": 0, "docs": docs}}
+    f = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    with f:
+        json.dump(payload, f)
+    return f.name
+
+
+def legacy_decode(response):
+    """
+    The decoding done before responses were parsed once: every accessor called ``response.json()`` again.
+    """
+    query_time = response.json()["responseHeader"]["QTime"]
+    total = response.json()["response"]["numFound"]
+    docs = sorted(response.json()["response"]["docs"], key=lambda d: d["timestamp"], reverse=True)
+    latest = {}
+    for doc in sorted(response.json()["response"]["docs"], key=lambda d: d["timestamp"], reverse=True):
+        latest.setdefault((doc["g"], doc["a"]), []).append(doc)
+    return query_time, total, docs, latest
+
+
+def wrapper_decode(response, stream):
+    wrapper = query_maven.ResponseWrapper(response, stream)
+    docs = wrapper.maven_docs()
+    return wrapper.query_time, wrapper.total, docs, wrapper.latest_versions(docs)
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser(prog="bench_query_maven",
+                        description="Benchmark the decoding of recorded Maven Central responses.",
+                        formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-n", "--num-docs", type=int, default=20000,
+                    help="The number of docs in the synthetic response used when no paths are given")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="The number of runs to take the best time of")
+    ap.add_argument("paths", nargs="*", help="Paths to recorded JSON responses")
+    ns = ap.parse_args(args)
+    paths = ns.paths or [synthesize_response(ns.num_docs)]
+    for path in paths:
+        response = RecordedResponse(path)
+        results = [wrapper_decode(response, stream) for stream in (False, True)] + [legacy_decode(response)]
+        if len(set(len(result[2]) for result in results)) != 1:
+            raise Exception("Decoders disagree on the number of docs in {0}".format(path))
+        print "{0} ({1} docs):".format(path, len(results[0][2]))
+        for label, func in [("legacy (json() per accessor)", lambda: legacy_decode(response)),
+                            ("single parse", lambda: wrapper_decode(response, False)),
+                            ("streaming parse", lambda: wrapper_decode(response, True))]:
+            print "\t{0:<30} {1:8.1f} ms".format(label, best_time(func, ns.repeat) * 1.0e3)
+    if not ns.paths:
+        os.remove(paths[0])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
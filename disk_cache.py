@@ -0,0 +1,145 @@
+"""
+A small persistent key/value cache of JSON-serializable values, with a time-to-live, and an on-disk copy of a web
+page that is revalidated with conditional requests.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from path import Path
+import requests
+
+logger = logging.getLogger(__name__)
+
+CACHE_ROOT = Path('~/.cache/pyscripts').expand()
+
+
+def atomic_write(path, data):
+    """
+    Replace the file at ``path`` with ``data`` atomically, so concurrent readers never see partial contents.
+    """
+    path = Path(path)
+    if not path.dirname().exists():
+        path.dirname().makedirs_p()
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class DiskCache(object):
+    """
+    Stores each value as a JSON file named after the hash of its key, under a cache directory.
+    """
+
+    def __init__(self, name, ttl=3600.0, bypass=False, root=CACHE_ROOT):
+        """
+        :param str name: The name of the cache, which is also its subdirectory under ``root``
+        :param float ttl: The number of seconds after which entries expire
+        :param bool bypass: True to ignore existing entries (new values are still stored)
+        """
+        self.directory = Path(root).joinpath(name)
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '{0}({1}, ttl={2}, hits={3}, misses={4})'.format(self.__class__.__name__, self.directory, self.ttl,
+                                                                self.hits, self.misses)
+
+    def path_for(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        return self.directory.joinpath(digest[:2], '{0}.json'.format(digest))
+
+    def get(self, key, default=None):
+        """
+        :param key: Any JSON-serializable key
+        :return: The cached value, or ``default`` if it is missing, expired or the cache is bypassed
+        """
+        path = self.path_for(key)
+        if self.bypass or not path.exists():
+            self.misses += 1
+            return default
+        try:
+            with open(path, 'rb') as f:
+                entry = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Ignoring unreadable cache entry %s: %s', path, e)
+            self.misses += 1
+            return default
+        if time.time() - entry['time'] > self.ttl:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry['value']
+
+    def set(self, key, value):
+        """
+        Store ``value`` under ``key``, replacing the file atomically so concurrent readers never see partial entries.
+        """
+        atomic_write(self.path_for(key), json.dumps({'time': time.time(), 'key': key, 'value': value}))
+        return value
+
+
+class CachedPage(object):
+    """
+    A web page stored on disk with its ``ETag`` and ``Last-Modified`` validators. Each :meth:`refresh` sends a
+    conditional request, so an unchanged page costs a ``304 Not Modified`` instead of a full download.
+    """
+
+    def __init__(self, url, name, root=CACHE_ROOT):
+        """
+        :param str url: The URL of the page
+        :param str name: The name of the cache subdirectory holding the page and anything derived from it
+        """
+        self.url = url
+        self.directory = Path(root).joinpath(name)
+        self.content_path = self.directory.joinpath('page.html')
+        self.meta_path = self.directory.joinpath('page.json')
+        self.meta = {}
+        if self.meta_path.exists() and self.content_path.exists():
+            try:
+                with open(self.meta_path, 'rb') as f:
+                    self.meta = json.load(f)
+            except (IOError, ValueError) as e:
+                logger.warning('Ignoring unreadable page metadata %s: %s', self.meta_path, e)
+
+    def derived_path(self, file_name):
+        """
+        :return: The path of a file derived from the page, which :meth:`refresh` removes when the page changes
+        """
+        return self.directory.joinpath(file_name)
+
+    def refresh(self, session=None, timeout=30, force=False):
+        """
+        Revalidate (or fetch) the page.
+
+        :param bool force: True to download the page unconditionally
+        :return bool: True if the page content changed
+        """
+        headers = {}
+        if self.meta and not force:
+            if self.meta.get('etag'):
+                headers['If-None-Match'] = self.meta['etag']
+            if self.meta.get('last_modified'):
+                headers['If-Modified-Since'] = self.meta['last_modified']
+        resp = (session or requests).get(self.url, headers=headers, timeout=timeout)
+        if resp.status_code == requests.codes.not_modified:
+            logger.info('%s is unchanged since %s', self.url, self.meta.get('last_modified') or self.meta['etag'])
+            return False
+        resp.raise_for_status()
+        for path in self.directory.files() if self.directory.exists() else []:
+            if path not in (self.content_path, self.meta_path):
+                path.remove_p()
+        atomic_write(self.content_path, resp.content)
+        self.meta = {'url': resp.url, 'etag': resp.headers.get('ETag'),
+                     'last_modified': resp.headers.get('Last-Modified'), 'time': time.time()}
+        atomic_write(self.meta_path, json.dumps(self.meta))
+        return True
+
+    def content(self):
+        with open(self.content_path, 'rb') as f:
+            return f.read()
@@ -1,40 +1,210 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-try:
-    import sh
-    SUFFIX = ""
-except ImportError:
-    import pbs as sh
-    SUFFIX = ".exe"
+from multiprocessing.pool import ThreadPool
 import os
+import posixpath
 import sys
+import threading
+import time
+
+import expect_engine
+
+ERROR_MARKERS = ("Permission denied", "No such file", "Failure", "Couldn't", "not found")
 
 
 class RemoteSender(object):
 
     def __init__(self, source_file, dest_file, password):
-        self.aggregated = ""
-        self.unbuffered_stdout = os.fdopen(sys.stdout.fileno(), "wb", 0)
         self.source_file = source_file
         self.dest_file = dest_file
         self.state = 0
         self.password = password
+        self.expecter = expect_engine.Expecter(echo=expect_engine.unbuffered_stdout())
+        self.expecter.on(r"password:\s*$", self.send_password)
+        self.expecter.on(r"sftp>\s*$", self.send_command)
 
-    def ssh_interact(self, char, stdin):
-        self.unbuffered_stdout.write(char.encode())
-        self.aggregated += char
-        if self.aggregated.endswith("password: "):
-            stdin.put(self.password)
-            stdin.put("\n")
-            self.state = 1
-        elif self.aggregated.endswith("sftp> ") and self.state == 1:
-            stdin.put("put {0!r} {1!r}\n".format(self.source_file, self.dest_file))
+    def send_password(self, match, send):
+        send("{0}\n".format(self.password))
+        self.state = 1
+
+    def send_command(self, match, send):
+        if self.state == 1:
+            send("put {0!r} {1!r}\n".format(self.source_file, self.dest_file))
             self.state = 2
-        elif self.aggregated.endswith("sftp> ") and self.state == 2:
-            stdin.put("exit\n")
+        elif self.state == 2:
+            send("exit\n")
             self.state = 3
 
 
+class Transfer(object):
+    """
+    A single file of a batch upload.
+    """
+
+    def __init__(self, source_file, dest_file):
+        self.source_file = source_file
+        self.dest_file = dest_file
+        self.size = os.path.getsize(source_file)
+        self.seconds = 0.0
+        self.error = None
+
+    def __repr__(self):
+        if self.error is not None:
+            return "{0.source_file} -> {0.dest_file}: FAILED ({0.error})".format(self)
+        speed = self.size / self.seconds / 1024 if self.seconds else 0.0
+        return "{0.source_file} -> {0.dest_file}: {0.size} bytes, {1:0.1f} KiB/s".format(self, speed)
+
+
+class BatchProgress(object):
+    """
+    Progress shared by the sessions of a batch upload.
+    """
+
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.lock = threading.Lock()
+
+    def finished(self, transfer):
+        with self.lock:
+            self.done_files += 1
+            if transfer.error is None:
+                self.done_bytes += transfer.size
+            print "[{0}/{1}] {2!r}".format(self.done_files, self.total_files, transfer)
+
+
+class BatchSender(object):
+    """
+    Runs a list of commands in a single sftp session, sending the next one at each prompt.
+    """
+
+    def __init__(self, transfers, password, progress, remote_dirs=()):
+        self.password = password
+        self.progress = progress
+        self.commands = ["-mkdir {0!r}".format(d) for d in remote_dirs]
+        self.commands.extend(transfers)
+        self.current = None
+        self.started = None
+        self.expecter = expect_engine.Expecter()
+        self.expecter.on(r"password:\s*$", self.send_password)
+        self.expecter.on(r"sftp>\s*$", self.send_next)
+
+    def send_password(self, match, send):
+        send("{0}\n".format(self.password))
+
+    def send_next(self, match, send):
+        if self.current is not None:
+            output = match.string[:match.start()]
+            errors = [line.strip() for line in output.splitlines() if any(m in line for m in ERROR_MARKERS)]
+            self.current.seconds = time.time() - self.started
+            self.current.error = errors[0] if errors else None
+            self.progress.finished(self.current)
+            self.current = None
+        if not self.commands:
+            send("exit\n")
+            return
+        command = self.commands.pop(0)
+        if isinstance(command, Transfer):
+            self.current = command
+            self.started = time.time()
+            command = "put {0!r} {1!r}".format(command.source_file, command.dest_file)
+        send(command + "\n")
+
+    def finish(self, status):
+        """
+        Fail the transfers the session did not confirm (the one in flight and those never sent), once it has ended.
+
+        :param int status: The exit status of the session
+        :return int: ``status``
+        """
+        unconfirmed = [self.current] if self.current is not None else []
+        unconfirmed.extend(command for command in self.commands if isinstance(command, Transfer))
+        for transfer in unconfirmed:
+            transfer.error = "sftp exited with status {0} before confirming the upload".format(status)
+            self.progress.finished(transfer)
+        self.current = None
+        self.commands = []
+        return status
+
+
+def collect_tree(source_dir, dest_dir):
+    """
+    :return tuple: The ``(transfers, remote_dirs)`` replicating ``source_dir`` under ``dest_dir``, with parent
+                   directories listed before their children
+    """
+    transfers, remote_dirs = [], [dest_dir]
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        dir_names.sort()
+        rel_path = os.path.relpath(dir_path, source_dir)
+        remote_dir = dest_dir if rel_path == os.curdir else posixpath.join(dest_dir, *rel_path.split(os.sep))
+        if remote_dir != dest_dir:
+            remote_dirs.append(remote_dir)
+        for file_name in sorted(file_names):
+            transfers.append(Transfer(os.path.join(dir_path, file_name), posixpath.join(remote_dir, file_name)))
+    return transfers, remote_dirs
+
+
+def read_batch_file(batch_path):
+    """
+    :param str batch_path: A file with one tab-separated ``source<TAB>destination`` pair per line
+    """
+    with open(batch_path) as f:
+        pairs = [line.rstrip("\n").split("\t") for line in f if line.strip() and not line.startswith("#")]
+    return [Transfer(source_file, dest_file) for source_file, dest_file in pairs]
+
+
+def shard(transfers, sessions):
+    """
+    Split the transfers into at most ``sessions`` shards of similar total size, largest files first.
+    """
+    shards = [[] for _ in xrange(max(1, min(sessions, len(transfers))))]
+    sizes = [0] * len(shards)
+    for transfer in sorted(transfers, key=lambda t: t.size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(transfer)
+        sizes[smallest] += transfer.size
+    return shards
+
+
+def batch_upload(command, transfers, password, sessions=4, remote_dirs=()):
+    """
+    Upload many files over ``sessions`` parallel sftp sessions. The remote directories are created by every
+    session before its uploads, as ``-mkdir`` (which ignores existing directories).
+
+    :param list command: The sftp command line, e.g. ``["sftp", "-P", "22", "user@host"]``
+    :return tuple: ``(transfers, statuses)``: the :class:`Transfer` objects, with their timings and errors (including
+                   every transfer a failed session did not confirm), and the exit status of each session
+    """
+    progress = BatchProgress(len(transfers), sum(t.size for t in transfers))
+    shards = shard(transfers, sessions)
+
+    def run_session(session_transfers):
+        sender = BatchSender(session_transfers, password, progress, remote_dirs)
+        return sender.finish(expect_engine.spawn(command, sender.expecter))
+
+    start = time.time()
+    pool = ThreadPool(len(shards))
+    try:
+        statuses = pool.map(run_session, shards)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    failed = [t for t in transfers if t.error is not None]
+    print "Uploaded {0} files ({1} bytes) over {2} sessions in {3:0.2f}s: {4:0.1f} KiB/s, {5} failed".format(
+        len(transfers) - len(failed), progress.done_bytes, len(shards), elapsed,
+        progress.done_bytes / elapsed / 1024 if elapsed else 0.0, len(failed))
+    for transfer in failed:
+        print "\t{0!r}".format(transfer)
+    failed_sessions = [status for status in statuses if status != 0]
+    if failed_sessions:
+        print "{0} of {1} sessions failed, with exit statuses {2}".format(len(failed_sessions), len(statuses),
+                                                                          ", ".join(map(str, failed_sessions)))
+    return transfers, statuses
+
+
 def parse_args(args):
 
     def parse_site(remote_site):
@@ -50,6 +220,10 @@ def parse_args(args):
     ap.add_argument("-u", "--user", help="The remote user name")
     ap.add_argument("-p", "--password", help="The remote user password")
     ap.add_argument("-r", "--remote", help="The remote site, in the form of host:port", type=parse_site)
+    ap.add_argument("-b", "--batch", help="Upload the tab-separated source/destination pairs listed in this file")
+    ap.add_argument("-t", "--tree", help="Upload this local directory tree under the destination path")
+    ap.add_argument("-n", "--sessions", type=int, default=4, help="The number of parallel sessions of a batch upload")
+    ap.add_argument("--sftp", default="sftp", help="The sftp command, e.g. fake_sftp.py (a local stand-in) for testing")
     parser_ns = ap.parse_args(args)
     parser_ns.url = "{0}@{1}".format(parser_ns.user, parser_ns.remote[-1])
     return parser_ns
@@ -57,11 +231,18 @@ def parse_args(args):
 
 def main(args):
     parser_ns = parse_args(args)
-    sender = RemoteSender(parser_ns.source, parser_ns.dest, parser_ns.password)
-    command = sh.Command('sftp' + SUFFIX).bake(parser_ns.remote[:-1], parser_ns.url)
-    process = command(_out=sender.ssh_interact, _out_bufsize=0, _tty_in=True)
-    process.wait()
+    command = [parser_ns.sftp] + parser_ns.remote[:-1] + [parser_ns.url]
+    if parser_ns.batch is None and parser_ns.tree is None:
+        sender = RemoteSender(parser_ns.source, parser_ns.dest, parser_ns.password)
+        return expect_engine.spawn(command, sender.expecter)
+    transfers, remote_dirs = [], []
+    if parser_ns.tree is not None:
+        transfers, remote_dirs = collect_tree(parser_ns.tree, parser_ns.dest or ".")
+    if parser_ns.batch is not None:
+        transfers.extend(read_batch_file(parser_ns.batch))
+    transfers, statuses = batch_upload(command, transfers, parser_ns.password, parser_ns.sessions, remote_dirs)
+    return 1 if any(t.error is not None for t in transfers) or any(statuses) else 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
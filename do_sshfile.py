@@ -1,97 +1,214 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-try:
-    import sh
-    SUFFIX = ""
-except ImportError:
-    import pbs as sh
-    SUFFIX = ".exe"
+from multiprocessing.pool import ThreadPool
 import os
 import logging
+import pipes
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 from os import path as osp
 import urlparse
-from lxml.html import etree, HTMLParser
 import sys
-import requests
+
+import expect_engine
+from disk_cache import CachedPage
+from wheel_index import WheelIndex, iter_page_links, load_page_index
 
 WINPYTHON_LIBS_URL = "http://www.lfd.uci.edu/~gohlke/pythonlibs/"
 logging.getLogger().setLevel(logging.DEBUG)
 
 
-def fetch_winpython_lib_page():
-    """
-    Fetch the Windows Python compiled libraries page and return the parsed element tree.
-    """
-    resp = requests.get(WINPYTHON_LIBS_URL, timeout=30)
-    tree = etree.fromstring(resp.content, HTMLParser())
-    tree.make_links_absolute(resp.url)
-    return tree
-
-
 class WinPythonLibFinder(object):
 
-    JS_CALL_RGX = re.compile("javascript:dl[(](?P<char_codes>\\S+)\\s+\"(?P<encoded_link>[^\"]+)\"[)]")
-
     def __init__(self, tree=None):
-        if tree is None:
-            tree = fetch_winpython_lib_page()
+        """
+        :param tree: The parsed page; by default the index of the page cached on disk is used instead
+        """
         self.element = tree
+        self._index = None
 
-    def get_links_for_package(self, package_name):
-        xpath_arg = "//li[a[@id={0!r}]]/ul/li/a[@href]".format(package_name.lower())
-        elems = self.element.xpath(xpath_arg)
-        links_dict = {}
-        for elem in elems:
-            decoded_url = self.decode_link(elem)
-            complete_url = urlparse.urljoin(WINPYTHON_LIBS_URL, decoded_url)
-            elem.set("href", complete_url)
-            links_dict[elem.text] = elem.get("href")
-        return links_dict
-
-    def decode_link(self, link_element):
-        js_call = link_element.get("onclick")
-        js_call_dict = self.JS_CALL_RGX.match(js_call).groupdict()
-        js_call_dict["char_codes"] = eval(js_call_dict["char_codes"].rstrip(","))
-        decoded_chars = []
-        for char in js_call_dict["encoded_link"]:
-            decoded_char = js_call_dict["char_codes"][ord(char) - 48]
-            decoded_chars.append(chr(decoded_char))
-        decoded_link = "".join(decoded_chars)
-        return decoded_link
+    @property
+    def index(self):
+        """
+        The :class:`wheel_index.WheelIndex` of the page's files, built on first use.
+        """
+        if self._index is None:
+            if self.element is None:
+                self._index = load_page_index(CachedPage(WINPYTHON_LIBS_URL, "gohlke_pythonlibs"))
+            else:
+                self._index = WheelIndex.from_links(iter_page_links(self.element, WINPYTHON_LIBS_URL))
+        return self._index
+
+    def get_links_for_package(self, package_name, py_version=None, py_arch=None):
+        """
+        :return dict: A mapping of the file names of ``package_name`` to their URLs, optionally restricted to the
+                      files compatible with a Python version and architecture
+        """
+        if py_version is None:
+            wheel_files = self.index.find(package_name)
+        else:
+            wheel_files = self.index.find_compatible(py_version, py_arch or "64", package_name)
+        return dict((wheel_file.filename, wheel_file.url) for wheel_file in wheel_files)
 
 
 class RemoteSender(object):
 
     def __init__(self, password, command, link):
-        self.aggregated = ""
-        self.unbuffered_stdout = os.fdopen(sys.stdout.fileno(), "wb", 0)
         self.command = command
         self.link = link
         self.password = password
         self.remote_finished = False
         self.ssh_finished = False
+        self.expecter = expect_engine.Expecter(echo=expect_engine.unbuffered_stdout())
+        self.expecter.on(r"password:\s*$", self.send_password, re.IGNORECASE)
+        self.expecter.on(r"\$\s*$", self.send_command)
+
+    def send_password(self, match, send):
+        send("{0}\n".format(self.password))
 
-    def ssh_interact(self, char, stdin):
-        self.unbuffered_stdout.write(char.encode())
-        self.aggregated += char
-        if self.aggregated.lower().endswith("password: "):
-            stdin.put(self.password)
-            stdin.put("\n")
-            return
-        if self.aggregated.lower().endswith("$") and not self.remote_finished and not self.ssh_finished:
-            stdin.put(self.command)
-            stdin.put(" ")
-            stdin.put(repr(self.link))
-            stdin.put("\n")
+    def send_command(self, match, send):
+        if not self.remote_finished and not self.ssh_finished:
+            send("{0} {1!r}\n".format(self.command, self.link))
             self.remote_finished = True
-            return
-        if self.aggregated.lower().endswith("$") and self.remote_finished and not self.ssh_finished:
-            stdin.put("exit")
-            stdin.put("\n")
+        elif self.remote_finished and not self.ssh_finished:
+            send("exit\n")
             self.ssh_finished = True
             self.remote_finished = False
-            return
+
+
+class StreamedLink(object):
+    """
+    Byte counters of a link streamed back through SSH.
+    """
+
+    def __init__(self, link, dest_path):
+        self.link = link
+        self.dest_path = dest_path
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = None
+        self.done = False
+
+    def __repr__(self):
+        if self.error is not None:
+            return "{0.dest_path}: FAILED ({0.error})".format(self)
+        speed = self.bytes / self.seconds / 1024 if self.seconds else 0.0
+        return "{0.dest_path}: {0.bytes} bytes in {0.seconds:0.2f}s, {1:0.1f} KiB/s".format(self, speed)
+
+
+class ControlMaster(object):
+    """
+    A master SSH connection which later ``ssh`` invocations multiplex their sessions over, so that authentication
+    (and the password prompt) happens once.
+    """
+
+    def __init__(self, ssh_command, ssh_args, url, password):
+        self.ssh_command = ssh_command
+        self.ssh_args = ssh_args
+        self.url = url
+        self.password = password
+        self.control_dir = None
+
+    @property
+    def options(self):
+        return self.ssh_args + ["-o", "ControlPath={0}".format(osp.join(self.control_dir, "master"))]
+
+    def command(self, remote_command):
+        return [self.ssh_command] + self.options + [self.url, remote_command]
+
+    def __enter__(self):
+        self.control_dir = tempfile.mkdtemp(prefix="sshcm")
+        expecter = expect_engine.Expecter(echo=expect_engine.unbuffered_stdout())
+        expecter.on(r"password:\s*$", lambda match, send: send("{0}\n".format(self.password)), re.IGNORECASE)
+        # -f puts the master in the background once it is authenticated
+        status = expect_engine.spawn([self.ssh_command, "-M", "-N", "-f"] + self.options + [self.url], expecter)
+        if status != 0:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            raise Exception("ERROR: Unable to open the master connection to {0} (exit status {1})".format(
+                self.url, status))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        with open(os.devnull, "wb") as devnull:
+            subprocess.call([self.ssh_command, "-O", "exit"] + self.options + [self.url],
+                            stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+        return False  # propagate any exceptions
+
+
+def stream_link(master, stream_command, streamed, chunk_size=1 << 16):
+    """
+    Run the download on the proxy with its output on stdout, writing that output to the local file as it arrives.
+    """
+    start = time.time()
+    with open(os.devnull, "rb") as devnull, open(streamed.dest_path, "wb") as f:
+        proc = subprocess.Popen(master.command("{0} {1}".format(stream_command, pipes.quote(streamed.link))),
+                                stdin=devnull, stdout=subprocess.PIPE)
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), ""):
+            f.write(chunk)
+            streamed.bytes += len(chunk)
+        status = proc.wait()
+    streamed.seconds = time.time() - start
+    if status != 0:
+        streamed.error = "remote command exited with status {0}".format(status)
+        os.remove(streamed.dest_path)
+    streamed.done = True
+    return streamed
+
+
+def report_progress(streams, stop_event, interval=1.0):
+    while not stop_event.wait(interval):
+        sys.stdout.write("\r" + " | ".join("{0}: {1} KiB{2}".format(osp.basename(s.dest_path), s.bytes // 1024,
+                                                                    " (done)" if s.done else "")
+                                           for s in streams))
+        sys.stdout.flush()
+
+
+def dest_names(links):
+    """
+    :return list: The local file name of each link, which is its base name with a ``.1``, ``.2``... suffix (like
+                  wget's) when an earlier link has the same one
+    """
+    names, used = [], set()
+    for link in links:
+        base_name = osp.basename(urlparse.urlsplit(link).path) or "index.html"
+        name, count = base_name, 0
+        while name in used:
+            count += 1
+            name = "{0}.{1}".format(base_name, count)
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def stream_links(parser_ns, links):
+    """
+    Stream several links back from the proxy concurrently, over a single master connection.
+
+    :return list: The :class:`StreamedLink` of each link
+    """
+    streams = [StreamedLink(link, name) for link, name in zip(links, dest_names(links))]
+    with ControlMaster(parser_ns.ssh, parser_ns.remote[:-1], parser_ns.url, parser_ns.password) as master:
+        stop_event = threading.Event()
+        reporter = threading.Thread(target=report_progress, args=(streams, stop_event))
+        reporter.daemon = True
+        reporter.start()
+        pool = ThreadPool(max(1, min(parser_ns.jobs, len(streams))))
+        try:
+            pool.map(lambda s: stream_link(master, parser_ns.stream_command, s), streams)
+        finally:
+            pool.close()
+            pool.join()
+            stop_event.set()
+            reporter.join()
+    print
+    for streamed in streams:
+        print "\t{0!r}".format(streamed)
+    return streams
 
 
 def parse_args(args):
@@ -114,6 +231,14 @@ def parse_args(args):
                     help="The command to run on the proxy server to download the file")
     ap.add_argument("-S", "--skip-ssh", default=False, action="store_true",
                     help="Set this to true if the remote server already has the file")
+    ap.add_argument("-t", "--stream", default=False, action="store_true",
+                    help="Stream the downloads back through the SSH connection instead of copying them with scp")
+    ap.add_argument("-C", "--stream-command", default="curl -sfL",
+                    help="The command run on the proxy server to write a download to its stdout")
+    ap.add_argument("-j", "--jobs", type=int, default=4, help="The number of links streamed at once")
+    ap.add_argument("--ssh", default="ssh", help="The ssh command, e.g. a local stand-in for testing")
+    ap.add_argument("--scp", default="scp", help="The scp command fetching the file back, without --stream")
+    ap.add_argument("links", nargs="*", help="More links to stream (with --stream)")
     parser_ns = ap.parse_args(args)
     parser_ns.url = "{0}@{1}".format(parser_ns.user, parser_ns.remote[-1])
     return parser_ns
@@ -121,25 +246,21 @@ def parse_args(args):
 
 def main(args):
     parser_ns = parse_args(args)
+    if parser_ns.stream:
+        streams = stream_links(parser_ns, ([parser_ns.link] if parser_ns.link else []) + parser_ns.links)
+        return 1 if any(s.error is not None for s in streams) else 0
     sender = RemoteSender(parser_ns.password, parser_ns.command, parser_ns.link)
-    ssh_arg = "\"{0.command} {0.link!r}\"".format(parser_ns)
-    command = sh.Command("ssh" + SUFFIX).bake(parser_ns.remote[:-1],
-                                              "--user-agent", "Mozilla/5.0",
-                                              parser_ns.url)
-    logging.info("Running command: %s", command)
-    ssh_proc = command(_out=sender.ssh_interact, _out_bufsize=0, _tty_in=True)
-    ssh_proc.wait()
+    ssh_args = [parser_ns.ssh] + parser_ns.remote[:-1] + ["--user-agent", "Mozilla/5.0", parser_ns.url]
+    logging.info("Running command: %s", " ".join(ssh_args))
+    expect_engine.spawn(ssh_args, sender.expecter)
     scp_remote_args = parser_ns.remote[:-1]
     scp_remote_args.append("-v")
     if '-p' in scp_remote_args:
         arg_index = scp_remote_args.index("-p")
         scp_remote_args[arg_index] = "-P"
     scp_remote_path = repr(osp.split(urlparse.urlsplit(parser_ns.link).path)[-1])
-    scp_command = sh.Command("scp" + SUFFIX).bake(scp_remote_args,
-                                                  ":".join([parser_ns.url, scp_remote_path]),
-                                                  scp_remote_path)
-    scp_proc = scp_command(_out=sender.ssh_interact, _out_bufsize=0, _tty_in=True)
-    scp_proc.wait()
+    scp_args = [parser_ns.scp] + scp_remote_args + [":".join([parser_ns.url, scp_remote_path]), scp_remote_path]
+    expect_engine.spawn(scp_args, sender.expecter)
 
 
 if __name__ == "__main__":
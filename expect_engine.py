@@ -0,0 +1,120 @@
+"""
+A small expect engine for driving interactive programs such as ``ssh``, ``scp`` and ``sftp``.
+
+The child runs on a pseudo-terminal whose output is read in chunks of up to ``chunk_size`` bytes, and prompts are
+matched incrementally against a bounded tail of that output, so a long and chatty session costs linear time and
+constant memory. Where ``pty`` is not available (Windows), the child is run through ``pbs`` one character at a time,
+with the same matching.
+"""
+import errno
+import os
+import re
+import sys
+try:
+    import pty
+except ImportError:  # pragma: no cover
+    pty = None
+    import pbs as sh
+
+
+class Expecter(object):
+    """
+    Matches the output of a child process against a list of ``(regex, handler)`` rules.
+
+    Each time a rule matches, its handler is called with the match and a ``send`` function writing to the child's
+    input, and the tail is consumed up to the end of the match so that the same output never triggers twice.
+    """
+
+    def __init__(self, max_buffer=4096, echo=None):
+        """
+        :param int max_buffer: The number of trailing output characters kept for matching; it must be longer than
+                               anything a rule needs to see at once
+        :param echo: A file object the output is copied to, or None to discard it
+        """
+        self.max_buffer = max_buffer
+        self.echo = echo
+        self.tail = ""
+        self.rules = []
+
+    def on(self, pattern, handler, flags=0):
+        """
+        Register a rule; the rules are tried in registration order.
+
+        :param pattern: A regex (string or compiled); anchor it with ``\\s*$`` to match prompts
+        :param handler: Called as ``handler(match, send)``
+        """
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern, flags)
+        self.rules.append((pattern, handler))
+        return self
+
+    def feed(self, data, send):
+        """
+        Process a chunk of the child's output.
+
+        :param str data: The new output
+        :param send: A function writing a string to the child's input
+        """
+        if self.echo is not None:
+            self.echo.write(data)
+        self.tail += data
+        matched = True
+        while matched and self.tail:
+            matched = False
+            for pattern, handler in self.rules:
+                match = pattern.search(self.tail)
+                if match is not None:
+                    self.tail = self.tail[match.end():]
+                    handler(match, send)
+                    matched = True
+                    break
+        if len(self.tail) > self.max_buffer:
+            self.tail = self.tail[-self.max_buffer:]
+
+
+def unbuffered_stdout():
+    # Duplicate the descriptor so that closing (or garbage collecting) the file object leaves stdout open
+    return os.fdopen(os.dup(sys.stdout.fileno()), "wb", 0)
+
+
+def spawn(argv, expecter, chunk_size=4096):
+    """
+    Run a command on a pseudo-terminal, feeding its output to ``expecter`` until it exits.
+
+    :param list argv: The command and its arguments
+    :param Expecter expecter: The rules answering the command's prompts
+    :param int chunk_size: The maximum number of bytes read at once
+    :return int: The exit status of the command
+    """
+    if pty is None:  # pragma: no cover
+        command = sh.Command(argv[0] + ".exe")
+        process = command(*argv[1:], _out=lambda char, stdin: expecter.feed(char, stdin.put),
+                          _out_bufsize=0, _tty_in=True)
+        process.wait()
+        return process.exit_code
+    pid, fd = pty.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+
+    def send(data):
+        while data:
+            data = data[os.write(fd, data):]
+
+    try:
+        while True:
+            try:
+                data = os.read(fd, chunk_size)
+            except OSError as e:
+                if e.errno != errno.EIO:  # EIO means the child closed the terminal
+                    raise
+                break
+            if not data:
+                break
+            expecter.feed(data, send)
+    finally:
+        os.close(fd)
+        _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
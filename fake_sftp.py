@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+A stand-in for the interactive ``sftp`` client, for testing :mod:`do_sftp` without an SSH server.
+
+It prompts for a password, then answers ``put``, ``mkdir``/``-mkdir`` and ``exit`` at an ``sftp>`` prompt like the
+real client, copying files on the local filesystem (the remote paths are local paths). Failures are simulated through
+environment variables:
+
+``FAKE_SFTP_PASSWORD``
+    The only accepted password; after three wrong ones the session exits with status 255, like ``ssh``
+``FAKE_SFTP_EXIT_AFTER``
+    The number of uploads completed before the session drops (with status 1) while the next one is in flight
+
+e.g. ``do_sftp.py --sftp ./fake_sftp.py -u user -p secret -r localhost -t some_dir -d /tmp/dest``
+"""
+import os
+import shlex
+import shutil
+import sys
+
+MAX_PASSWORD_PROMPTS = 3
+
+
+def write(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def authenticate(password):
+    for _ in range(MAX_PASSWORD_PROMPTS):
+        write("user@host's password: ")
+        answer = sys.stdin.readline().rstrip("\r\n")
+        if password is None or answer == password:
+            return True
+        write("Permission denied, please try again.\n")
+    write("Permission denied (publickey,password).\n")
+    return False
+
+
+def main():
+    if not authenticate(os.environ.get("FAKE_SFTP_PASSWORD")):
+        return 255
+    exit_after = os.environ.get("FAKE_SFTP_EXIT_AFTER")
+    uploads = 0
+    write("Connected to host.\n")
+    while True:
+        write("sftp> ")
+        line = sys.stdin.readline()
+        if not line:
+            return 0
+        parts = shlex.split(line)
+        if not parts:
+            continue
+        if parts[0] in ("exit", "quit", "bye"):
+            return 0
+        if parts[0].lstrip("-") == "mkdir":
+            try:
+                os.mkdir(parts[1])
+            except OSError:
+                if not parts[0].startswith("-"):
+                    write("Couldn't create directory: Failure\n")
+        elif parts[0] == "put":
+            write("Uploading {0} to {1}\n".format(parts[1], parts[2]))
+            if exit_after is not None and uploads >= int(exit_after):
+                write("Connection closed\n")
+                return 1
+            try:
+                shutil.copy(parts[1], parts[2])
+            except (IOError, OSError):
+                write("remote open(\"{0}\"): No such file or directory\n".format(parts[2]))
+            uploads += 1
+        else:
+            write("Invalid command.\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""
+Helpers for listing the Java classes in a jar from its zip central directory, without extracting anything.
+"""
+import re
+import zipfile
+
+MULTI_RELEASE_RGX = re.compile("^META-INF/versions/[0-9]+/")
+SKIPPED_CLASSES = ("module-info", "package-info")
+
+
+def class_name(entry_name):
+    """
+    Convert a jar entry name into a fully qualified top-level class name.
+
+    :param str entry_name: The entry name, e.g. ``org/example/Foo$Bar.class``
+    :return: The class name (e.g. ``org.example.Foo``), or None if the entry is not a regular class
+    """
+    if not entry_name.endswith(".class"):
+        return None
+    entry_name = MULTI_RELEASE_RGX.sub("", entry_name)
+    if entry_name.startswith("META-INF/"):
+        return None
+    path = entry_name[:-len(".class")]
+    if path.rsplit("/", 1)[-1] in SKIPPED_CLASSES:
+        return None
+    return path.split("$", 1)[0].replace("/", ".")
+
+
+def jar_class_names(jar_path):
+    """
+    :param str jar_path: The path to a local jar
+    :return list: The sorted, unique top-level class names in the jar
+    """
+    with zipfile.ZipFile(jar_path) as jar:
+        names = set(class_name(info.filename) for info in jar.infolist())
+    names.discard(None)
+    return sorted(names)
+
+
+def group_by_package(class_names):
+    """
+    :param list class_names: Fully qualified class names
+    :return dict: A mapping of package names to the sorted class names in each package
+    """
+    packages = {}
+    for name in class_names:
+        packages.setdefault(name.rpartition(".")[0], []).append(name)
+    for names in packages.values():
+        names.sort()
+    return packages
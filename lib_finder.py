@@ -1,89 +1,173 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from multiprocessing.pool import ThreadPool
 import logging
-import re
 import requests
 import os
+import time
 import urlparse
-from lxml.html import etree, HTMLParser
 import sys
 
+from disk_cache import CachedPage
+from wheel_index import WheelIndex, iter_page_links, load_page_index
+
 WINPYTHON_LIBS_URL = "http://www.lfd.uci.edu/~gohlke/pythonlibs/"
-JS_CALL_RGX = re.compile("javascript:dl[(](?P<char_codes>\\S+)\\s+\"(?P<encoded_link>[^\"]+)\"[)]")
-PKG_NAME_RGX = re.compile("^(.*?)-(?:[0-9]|Py)")
-LINK_XPATH = "//a[@href][@onclick][@title]"
+NO_PROXY_SCHEMES = ("http", "https", "ftp")
 
 logging.getLogger().setLevel(logging.DEBUG)
 
 
-def fetch_winpython_lib_page():
+def load_winpython_lib_index(session=None, force=False):
+    """
+    Load the :class:`wheel_index.WheelIndex` of the Windows Python compiled libraries page, revalidating the copy
+    cached on disk instead of downloading and parsing the page on every run.
     """
-    Fetch the Windows Python compiled libraries page and return the parsed element tree.
+    return load_page_index(CachedPage(WINPYTHON_LIBS_URL, "gohlke_pythonlibs"), session, force)
+
+
+class DownloadStats(object):
+    """
+    The outcome of a single file download.
+    """
+
+    def __init__(self, package_name, dest_path):
+        self.package_name = package_name
+        self.dest_path = dest_path
+        self.resumed_from = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = None
 
-    :return: The parsed element tree
-    :rtype: :class:`lxml.html.Element`
+    @property
+    def speed(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        if self.error is not None:
+            return "{0.package_name}: FAILED ({0.error})".format(self)
+        resumed = " (resumed at {0} bytes)".format(self.resumed_from) if self.resumed_from else ""
+        return "{0.package_name}: {0.bytes} bytes in {0.seconds:0.2f}s, {1:0.1f} KiB/s{2} -> {0.dest_path}".format(
+            self, self.speed / 1024, resumed)
+
+
+def make_session(jobs=4):
+    """
+    :return: A :class:`requests.Session` whose connection pool can serve ``jobs`` concurrent downloads
     """
-    resp = requests.get(WINPYTHON_LIBS_URL, timeout=30)
-    tree = etree.fromstring(resp.content, HTMLParser())
-    tree.make_links_absolute(resp.url)
-    return tree
+    session = requests.Session()
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class WinPythonLibFinder(object):
 
-    def __init__(self, element):
+    def __init__(self, element, session=None, link_index=None):
+        """
+        :param element: The parsed page; may be None when its ``link_index`` is given
+        """
         self.element = element
+        self.session = session or make_session()
+        self._link_index = link_index
+        self._matching_links = {}
+
+    @property
+    def link_index(self):
+        """
+        The :class:`wheel_index.WheelIndex` of the page's files, built on first use and reused afterwards.
+        """
+        if self._link_index is None:
+            self._link_index = WheelIndex.from_links(iter_page_links(self.element, WINPYTHON_LIBS_URL))
+        return self._link_index
 
     def get_matching_links(self, py_version=None, py_arch=None):
         py_version = py_version or '{0}.{1}'.format(*sys.version_info)
         py_arch = str(py_arch or len('{0:x}'.format(sys.maxint)) * 4)
-        other_arch = {"64": "32", "32": "64"}[py_arch]
-        link_dict = {}
-        for match in self.element.xpath(LINK_XPATH):
-            title = match.text.replace(u"\u2011", "-")
-            if any((py_version.replace('.', '') not in title,
-                    "{0}.".format(py_arch) not in title,
-                    "{0}.".format(other_arch) in title)):
-                continue
-            pkg_name_match = PKG_NAME_RGX.search(title)
-            if pkg_name_match is None:
-                continue
-            package_name = pkg_name_match.group(1)
-            link_dict[package_name] = self.decode_link(match)
-        return link_dict
-
-    def decode_link(self, link_element):
-        js_call = link_element.get("onclick")
-        js_call_dict = JS_CALL_RGX.match(js_call).groupdict()
-        js_call_dict["char_codes"] = eval(js_call_dict["char_codes"].rstrip(","))
-        decoded_chars = []
-        for char in js_call_dict["encoded_link"]:
-            decoded_char = js_call_dict["char_codes"][ord(char) - 48]
-            decoded_chars.append(chr(decoded_char))
-        decoded_link = "".join(decoded_chars)
-        actual_link = urlparse.urljoin(WINPYTHON_LIBS_URL, decoded_link)
-        return actual_link
+        key = (py_version, py_arch)
+        if key not in self._matching_links:
+            self._matching_links[key] = dict((name, wheel_file.url) for name, wheel_file in
+                                             self.link_index.newest_compatible(py_version, py_arch).items())
+        return self._matching_links[key]
 
     def list_packages(self, py_version=None, py_arch=None):
         matching_links = self.get_matching_links(py_version, py_arch)
         for package_name, package_url in sorted(matching_links.items()):
             print "Package {0!r} -> {1!r}".format(package_name, package_url)
 
-    def download_package(self, package_name, no_proxies=False, py_version=None, py_arch=None):
+    def download_package(self, package_name, no_proxies=False, py_version=None, py_arch=None, chunk_size=1 << 16):
+        """
+        Stream a package to the current directory. The file is written as ``<name>.part`` first, and a partial file
+        left by an interrupted run is resumed with a Range request (or discarded, if the server rejects the range).
+
+        :return: The :class:`DownloadStats` of the download
+        """
         matching_links = self.get_matching_links(py_version, py_arch)
         if package_name not in matching_links:
             raise Exception("ERROR: Package {0!r} not in available packages!".format(package_name))
         package_url = matching_links[package_name]
         package_filename = os.path.split(urlparse.urlparse(package_url).path)[-1]
         dest_path = os.path.abspath(os.path.join(os.path.curdir, package_filename))
+        part_path = dest_path + ".part"
+        stats = DownloadStats(package_name, dest_path)
         print "Downloading package {0!r} to {1}\n\tURL:{2!r}".format(package_name, dest_path, package_url)
-        request_args = {"url": package_url, "headers": {"User-Agent": "Mozilla/5.0"}}
+        request_args = {"url": package_url, "stream": True, "timeout": (5, 60), "headers": {}}
         if no_proxies:
-            request_args["proxies"] = {"http": None, "https": None, "ftp": None}
-        resp = requests.get(**request_args)
-        with open(dest_path, "wb") as f:
-            f.write(resp.content)
-        print "Download completed successfully!"
+            request_args["proxies"] = dict.fromkeys(NO_PROXY_SCHEMES)  # requests may update the mapping it is given
+        if os.path.exists(part_path):
+            stats.resumed_from = os.path.getsize(part_path)
+            request_args["headers"]["Range"] = "bytes={0}-".format(stats.resumed_from)
+        start = time.time()
+        resp = self.session.get(**request_args)
+        if resp.status_code == requests.codes.requested_range_not_satisfiable and stats.resumed_from:
+            # The partial file may be complete, but nothing tells it apart from a stale or corrupt one
+            logging.warning("Discarding %s, which the server cannot resume, and restarting", part_path)
+            resp.close()
+            os.remove(part_path)
+            stats.resumed_from = 0
+            del request_args["headers"]["Range"]
+            resp = self.session.get(**request_args)
+        try:
+            resp.raise_for_status()
+            if resp.status_code != requests.codes.partial_content:
+                stats.resumed_from = 0
+            with open(part_path, "ab" if stats.resumed_from else "wb") as f:
+                for chunk in resp.iter_content(chunk_size):
+                    f.write(chunk)
+                    stats.bytes += len(chunk)
+        finally:
+            resp.close()
+            stats.seconds = time.time() - start
+        os.rename(part_path, dest_path)
+        print "Download of {0!r} completed successfully!".format(package_name)
+        return stats
+
+    def download_packages(self, package_names, jobs=4, **kwargs):
+        """
+        Download several packages concurrently; failures are recorded in the returned stats rather than raised.
+
+        :param int jobs: The maximum number of concurrent downloads
+        :param kwargs: Passed on to :meth:`download_package`
+        :return list: The :class:`DownloadStats` of each package, in the order of ``package_names``
+        """
+        self.get_matching_links(kwargs.get("py_version"), kwargs.get("py_arch"))  # Build the index only once
+
+        def download(package_name):
+            try:
+                return self.download_package(package_name, **kwargs)
+            except Exception as e:
+                logging.exception("Unable to download %r", package_name)
+                stats = DownloadStats(package_name, None)
+                stats.error = e
+                return stats
+
+        pool = ThreadPool(max(1, min(jobs, len(package_names))))
+        try:
+            return pool.map(download, package_names)
+        finally:
+            pool.close()
+            pool.join()
 
 
 def main(args=None):
@@ -111,21 +195,37 @@ def main(args=None):
                         action="store_true",
                         default=False,
                         help="Zero out/undefine any proxies defined in the current environment")
+    parser.add_argument("-f", "--refresh",
+                        action="store_true",
+                        default=False,
+                        help="Download the index page even if the cached copy is still current")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        default=4,
+                        help="The maximum number of libraries downloaded concurrently")
     parser.add_argument("libraries",
                         nargs="*",
                         metavar="LIB",
                         help="The names of libraries to download")
     parser_ns = parser.parse_args(args)
     print "Fetching initial index page..."
-    finder = WinPythonLibFinder(fetch_winpython_lib_page())
+    session = make_session(parser_ns.jobs)
+    finder = WinPythonLibFinder(None, session, load_winpython_lib_index(session, parser_ns.refresh))
     if parser_ns.list_only or not parser_ns.libraries:
         finder.list_packages(py_version=parser_ns.py_version, py_arch=parser_ns.py_arch)
         return
-    for lib_name in parser_ns.libraries:
-        finder.download_package(lib_name,
-                                no_proxies=parser_ns.no_proxies,
-                                py_version=parser_ns.py_version,
-                                py_arch=parser_ns.py_arch)
+    start = time.time()
+    results = finder.download_packages(parser_ns.libraries,
+                                       jobs=parser_ns.jobs,
+                                       no_proxies=parser_ns.no_proxies,
+                                       py_version=parser_ns.py_version,
+                                       py_arch=parser_ns.py_arch)
+    print "Downloaded {0} bytes in {1:0.2f}s:".format(sum(r.bytes for r in results), time.time() - start)
+    for result in results:
+        print "\t{0!r}".format(result)
+    failed = [r.package_name for r in results if r.error is not None]
+    if failed:
+        raise Exception("ERROR: Unable to download {0}".format(", ".join(failed)))
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Offline index of a local Maven repository (``~/.m2/repository`` by default).
+
+Every ``g:a:v`` found in the repository is recorded with its timestamp and the class names listed in its jar's
+central directory, in an SQLite store that is updated incrementally: artifacts whose files did not change since the
+last run are skipped.
+"""
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import zipfile
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from path import Path
+
+from disk_cache import CACHE_ROOT
+import jar_classes
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_REPOSITORY = Path("~/.m2/repository").expand()
+DEFAULT_INDEX_PATH = CACHE_ROOT.joinpath("m2_index.db")
+FIELD_RGX = re.compile(r'\b(g|a|v|c|fc|p):"?([^"\s]+)"?')
+OR_RGX = re.compile(r"\s+OR\s+")
+UNSUPPORTED_RGX = re.compile(r"[()]|\bNOT\b")
+ARTIFACT_EXTENSIONS = (".jar", ".war", ".aar", ".pom")
+
+
+class UnsupportedQuery(ValueError):
+    """
+    Raised for a query using syntax the index cannot answer, such as parentheses or ``NOT``.
+    """
+
+
+def parse_query(search_term):
+    """
+    :return list: The alternatives of a query joined by ``OR``, each as a ``(fields, term)`` tuple where ``fields`` is
+                  the list of its ``(field, value)`` clauses (joined by ``AND``) and ``term`` the plain term to match
+                  when there are none
+    :raises UnsupportedQuery: If the query uses parentheses or ``NOT``
+    """
+    if UNSUPPORTED_RGX.search(search_term):
+        raise UnsupportedQuery("Unable to answer {0!r} from the local index".format(search_term))
+    return [(FIELD_RGX.findall(alternative), alternative.strip().strip('"'))
+            for alternative in OR_RGX.split(search_term.strip())]
+
+
+def alternative_clause(fields, term):
+    """
+    :return tuple: The SQL condition matching one alternative of :func:`parse_query`, and its parameters
+    """
+    clauses, params = [], []
+    for field, value in fields:
+        if field in ("c", "fc"):
+            clauses.append("artifacts.id IN (SELECT artifact_id FROM classes WHERE {0} = ?)".format(
+                "name" if field == "fc" else "simple"))
+        else:
+            clauses.append("artifacts.{0} = ?".format(field))
+        params.append(value)
+    if not fields:
+        clauses.append("(artifacts.g LIKE ? OR artifacts.a LIKE ?)")
+        params.extend(["%{0}%".format(term)] * 2)
+    return "({0})".format(" AND ".join(clauses)), params
+
+
+def find_artifact_files(top_dir, repository):
+    """
+    Walk ``top_dir`` (a directory inside ``repository``) for artifact files laid out as ``g/a/v/a-v.ext``.
+
+    :return list: ``(g, a, v, packaging, path, mtime)`` tuples, one per version directory
+    """
+    artifacts = []
+    for dir_path, _, file_names in os.walk(top_dir):
+        rel_parts = os.path.relpath(dir_path, repository).split(os.sep)
+        if len(rel_parts) < 3:
+            continue
+        group, artifact, version = ".".join(rel_parts[:-2]), rel_parts[-2], rel_parts[-1]
+        base_name = "{0}-{1}".format(artifact, version)
+        for ext in ARTIFACT_EXTENSIONS:
+            if base_name + ext in file_names:
+                file_path = os.path.join(dir_path, base_name + ext)
+                artifacts.append((group, artifact, version, ext[1:], file_path, os.path.getmtime(file_path)))
+                break
+    return artifacts
+
+
+def read_class_names(file_path):
+    if file_path.endswith(".pom"):
+        return []
+    try:
+        return jar_classes.jar_class_names(file_path)
+    except (zipfile.BadZipfile, IOError) as e:
+        logger.warning("Unable to read classes from %s: %s", file_path, e)
+        return []
+
+
+class M2Index(object):
+    """
+    The SQLite store holding the artifacts and classes of one or more local repositories.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = Path(path)
+        with self.transaction() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS artifacts (id INTEGER PRIMARY KEY, g TEXT, a TEXT, v TEXT, p TEXT,
+                                                      timestamp INTEGER, path TEXT UNIQUE, mtime REAL);
+                CREATE TABLE IF NOT EXISTS classes (artifact_id INTEGER, name TEXT, simple TEXT);
+                CREATE INDEX IF NOT EXISTS artifacts_g ON artifacts (g);
+                CREATE INDEX IF NOT EXISTS artifacts_a ON artifacts (a);
+                CREATE INDEX IF NOT EXISTS classes_name ON classes (name);
+                CREATE INDEX IF NOT EXISTS classes_simple ON classes (simple);
+                CREATE INDEX IF NOT EXISTS classes_artifact ON classes (artifact_id);
+            """)
+
+    def connect(self):
+        if not self.path.dirname().exists():
+            self.path.dirname().makedirs_p()
+        return sqlite3.connect(self.path)
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def update(self, repository=DEFAULT_REPOSITORY, jobs=8):
+        """
+        Index (or re-index) every artifact under ``repository`` whose file changed since the last update, and drop
+        the artifacts that disappeared from it.
+
+        :return tuple: ``(indexed, unchanged, removed)`` artifact counts
+        """
+        repository = Path(repository).expand().abspath()
+        start = time.time()
+        pool = ThreadPool(jobs)
+        try:
+            found = [a for batch in pool.imap_unordered(lambda d: find_artifact_files(d, repository),
+                                                        repository.dirs())
+                     for a in batch]
+            with self.transaction() as conn:
+                known = dict((row[0], (row[1], row[2])) for row in
+                             conn.execute("SELECT path, mtime, id FROM artifacts")
+                             if row[0].startswith(repository + os.sep))
+                changed = [a for a in found if a[4] not in known or known[a[4]][0] != a[5]]
+                seen = set(a[4] for a in found)
+                stale_ids = [known[a[4]][1] for a in changed if a[4] in known]
+                removed_ids = [artifact_id for file_path, (_, artifact_id) in known.items() if file_path not in seen]
+                for artifact_id in stale_ids + removed_ids:
+                    conn.execute("DELETE FROM classes WHERE artifact_id = ?", (artifact_id,))
+                    conn.execute("DELETE FROM artifacts WHERE id = ?", (artifact_id,))
+                for artifact, class_names in zip(changed, pool.imap(lambda a: read_class_names(a[4]), changed)):
+                    group, name, version, packaging, file_path, mtime = artifact
+                    cursor = conn.execute("INSERT INTO artifacts (g, a, v, p, timestamp, path, mtime) "
+                                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          (group, name, version, packaging, int(mtime * 1000), file_path, mtime))
+                    conn.executemany("INSERT INTO classes VALUES (?, ?, ?)",
+                                     [(cursor.lastrowid, c, c.rpartition(".")[-1]) for c in class_names])
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("Indexed %d artifacts (%d unchanged, %d removed) from %s in %0.2fs", len(changed),
+                    len(found) - len(changed), len(removed_ids), repository, time.time() - start)
+        return len(changed), len(found) - len(changed), len(removed_ids)
+
+    def search(self, search_term, num_rows=512, start=0):
+        """
+        Answer a Maven Central style query (``g:``, ``a:``, ``v:``, ``p:``, ``c:`` and ``fc:`` fields joined by
+        ``AND``, or a plain term matched against group and artifact IDs, with alternatives joined by ``OR``) from the
+        index.
+
+        :return tuple: ``(num_found, docs)``, where each doc is a dict shaped like a Maven Central doc
+        :raises UnsupportedQuery: If the query uses syntax the index cannot answer
+        """
+        clauses, params = [], []
+        for fields, term in parse_query(search_term):
+            clause, clause_params = alternative_clause(fields, term)
+            clauses.append(clause)
+            params.extend(clause_params)
+        where = " WHERE {0}".format(" OR ".join(clauses))
+        with self.transaction() as conn:
+            num_found = conn.execute("SELECT COUNT(*) FROM artifacts" + where, params).fetchone()[0]
+            rows = conn.execute("SELECT artifacts.g, artifacts.a, artifacts.v, artifacts.p, artifacts.timestamp "
+                                "FROM artifacts" + where + " ORDER BY artifacts.timestamp DESC LIMIT ? OFFSET ?",
+                                params + [num_rows, start]).fetchall()
+        docs = [{"id": "{0}:{1}:{2}".format(g, a, v), "g": g, "a": a, "v": v, "p": p, "timestamp": timestamp}
+                for g, a, v, p, timestamp in rows]
+        return num_found, docs
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser("Local Maven repository indexer", formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-i", "--index", default=DEFAULT_INDEX_PATH, help="The path of the index database")
+    ap.add_argument("-j", "--jobs", type=int, default=8, help="The number of directories walked in parallel")
+    ap.add_argument("-q", "--query", default=None, help="Query the index instead of updating it")
+    ap.add_argument("repository", nargs="?", default=DEFAULT_REPOSITORY, help="The local repository to index")
+    parser_ns = ap.parse_args(args)
+    index = M2Index(parser_ns.index)
+    if parser_ns.query is None:
+        index.update(parser_ns.repository, parser_ns.jobs)
+        return
+    num_found, docs = index.search(parser_ns.query)
+    logger.info("Found %d local matches", num_found)
+    for doc in docs:
+        print "{0[id]} ({0[p]})".format(doc)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
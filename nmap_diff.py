@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Report what changed between two nmap scans of the same range: new and vanished hosts, opened and closed ports, and
+changed routes.
+
+Both files are streamed into mappings keyed by integer address, so the diff costs set operations linear in the
+number of hosts; only the changes are sorted for output.
+"""
+import json
+import sys
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from netaddr import IPAddress
+
+from nmap_xml_reader import iter_nmap_xml
+
+
+class ScanSnapshot(object):
+    """
+    The open ports and route of every address in a scan, keyed by ``(version, int)``.
+    """
+    __slots__ = ("ports", "routes")
+
+    def __init__(self):
+        self.ports = {}
+        self.routes = {}
+
+    @classmethod
+    def from_xml(cls, xml_file):
+        snapshot = cls()
+        for host in iter_nmap_xml(xml_file):
+            ports = frozenset(host.ports)
+            route = tuple((hop.index, hop.version, hop.ipaddr_int) for hop in host.hops)
+            for key in zip(host.address_versions, host.address_ints):
+                snapshot.ports[key] = ports
+                snapshot.routes[key] = route
+        return snapshot
+
+
+def format_address(key):
+    return str(IPAddress(key[1], key[0]))
+
+
+def format_route(route):
+    return [format_address((version, value)) for _, version, value in route]
+
+
+def diff_scans(old, new):
+    """
+    :param ScanSnapshot old: The earlier scan
+    :param ScanSnapshot new: The later scan
+    :return: An iterator of change dicts, each with a ``change`` key (``host_added``, ``host_removed``,
+             ``ports_opened``, ``ports_closed`` or ``route_changed``) and an ``address``, in address order. Routes
+             are only compared when both scans traced the host.
+    """
+    old_keys, new_keys = old.ports.viewkeys(), new.ports.viewkeys()
+    changes = [(key, {"change": "host_added", "ports": sorted(new.ports[key])}) for key in new_keys - old_keys]
+    changes.extend((key, {"change": "host_removed", "ports": sorted(old.ports[key])}) for key in old_keys - new_keys)
+    for key in old_keys & new_keys:
+        old_ports, new_ports = old.ports[key], new.ports[key]
+        if old_ports != new_ports:
+            if new_ports - old_ports:
+                changes.append((key, {"change": "ports_opened", "ports": sorted(new_ports - old_ports)}))
+            if old_ports - new_ports:
+                changes.append((key, {"change": "ports_closed", "ports": sorted(old_ports - new_ports)}))
+        if old.routes[key] != new.routes[key] and old.routes[key] and new.routes[key]:
+            changes.append((key, {"change": "route_changed", "old": format_route(old.routes[key]),
+                                  "new": format_route(new.routes[key])}))
+    changes.sort(key=lambda change: change[0])
+    for key, change in changes:
+        change["address"] = format_address(key)
+        yield change
+
+
+def format_change(change):
+    if change["change"] == "route_changed":
+        return "~ {0[address]} route: {1} => {2}".format(change, " -> ".join(change["old"]),
+                                                         " -> ".join(change["new"]))
+    symbol = {"host_added": "+", "host_removed": "-", "ports_opened": "+", "ports_closed": "-"}[change["change"]]
+    label = "" if change["change"].startswith("host") else " " + change["change"].split("_")[1]
+    return "{0} {1[address]}{2} ({3})".format(symbol, change, label, ", ".join(str(p) for p in change["ports"]))
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser("nmap scan diff", formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-j", "--json", action="store_true", default=False, help="Print the changes as JSON lines")
+    ap.add_argument("old_xml", help="The path of the earlier scan")
+    ap.add_argument("new_xml", help="The path of the later scan")
+    parser_ns = ap.parse_args(args)
+    old, new = ScanSnapshot.from_xml(parser_ns.old_xml), ScanSnapshot.from_xml(parser_ns.new_xml)
+    counts = {}
+    for change in diff_scans(old, new):
+        counts[change["change"]] = counts.get(change["change"], 0) + 1
+        print json.dumps(change, sort_keys=True) if parser_ns.json else format_change(change)
+    sys.stderr.write("{0} hosts before, {1} after: {2}\n".format(
+        len(old.ports), len(new.ports), ", ".join("{0} {1}".format(v, k) for k, v in sorted(counts.items()))))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
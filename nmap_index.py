@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+A persistent SQLite index of many nmap XML scans.
+
+Scan files are streamed in with :func:`nmap_xml_reader.iter_nmap_xml` and skipped when a file with the same content
+hash was already ingested. Hosts, open ports and traceroute hops are indexed by address, port and scan time, so
+questions such as "which hosts had 443 open last week" are answered without re-parsing any XML.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from lxml import etree
+from netaddr import IPAddress, IPNetwork
+
+from disk_cache import CACHE_ROOT
+from nmap_xml_reader import iter_nmap_xml
+
+logging.basicConfig()
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_INDEX_PATH = CACHE_ROOT.joinpath("nmap_index.db")
+LOW_MASK = (1 << 64) - 1
+
+
+def pack_address(value):
+    """
+    :return: The address as a 16-byte big-endian blob, which sorts like the address itself
+    """
+    return sqlite3.Binary(struct.pack("!QQ", value >> 64, value & LOW_MASK))
+
+
+def unpack_address(blob, version):
+    high, low = struct.unpack("!QQ", str(blob))
+    return IPAddress((high << 64) | low, version)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_scan_start(path):
+    """
+    :return int: The start time of a scan (the ``start`` attribute of ``<nmaprun>``), or its file's mtime
+    """
+    for _, elem in etree.iterparse(path, events=("start",), tag="nmaprun", recover=True, huge_tree=True):
+        if elem.get("start"):
+            return int(elem.get("start"))
+        break
+    return int(os.path.getmtime(path))
+
+
+def parse_since(since):
+    """
+    :param str since: A number of days (``7d``), hours (``12h``) or a date (``2016-05-01`` or ``2016-05-01 13:30``)
+    :return int: The matching Unix time
+    """
+    if since[-1] in "dh" and since[:-1].isdigit():
+        delta = timedelta(**{"days" if since[-1] == "d" else "hours": int(since[:-1])})
+        return int(time.time() - delta.total_seconds())
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(datetime.strptime(since, fmt).timetuple()))
+        except ValueError:
+            pass
+    raise ValueError("Unable to parse {0!r} as a number of days/hours or a date".format(since))
+
+
+class NmapIndex(object):
+    """
+    The SQLite store holding the hosts, ports and hops of every ingested scan.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        with self.transaction() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY, path TEXT, sha1 TEXT UNIQUE,
+                                                  start_time INTEGER, ingested REAL, hosts INTEGER);
+                CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, scan_id INTEGER, address BLOB,
+                                                  version INTEGER);
+                CREATE TABLE IF NOT EXISTS hostnames (host_id INTEGER, name TEXT);
+                CREATE TABLE IF NOT EXISTS ports (host_id INTEGER, port INTEGER);
+                CREATE TABLE IF NOT EXISTS hops (host_id INTEGER, ttl INTEGER, address BLOB, version INTEGER,
+                                                 rtt REAL);
+                CREATE INDEX IF NOT EXISTS scans_start ON scans (start_time);
+                CREATE INDEX IF NOT EXISTS hosts_address ON hosts (version, address);
+                CREATE INDEX IF NOT EXISTS hosts_scan ON hosts (scan_id);
+                CREATE INDEX IF NOT EXISTS hostnames_name ON hostnames (name);
+                CREATE INDEX IF NOT EXISTS hostnames_host ON hostnames (host_id);
+                CREATE INDEX IF NOT EXISTS ports_port ON ports (port);
+                CREATE INDEX IF NOT EXISTS ports_host ON ports (host_id);
+                CREATE INDEX IF NOT EXISTS hops_address ON hops (version, address);
+                CREATE INDEX IF NOT EXISTS hops_host ON hops (host_id);
+            """)
+
+    def connect(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return sqlite3.connect(self.path)
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def ingest(self, path):
+        """
+        Add a scan file to the index, unless a file with the same content was already ingested.
+
+        :return tuple: ``(scan_id, ingested)``, where ``ingested`` is False for a skipped file
+        """
+        start = time.time()
+        sha1 = file_digest(path)
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id FROM scans WHERE sha1 = ?", (sha1,)).fetchone()
+            if row is not None:
+                logger.info("Skipping %s, already ingested as scan %d", path, row[0])
+                return row[0], False
+            scan_id = conn.execute("INSERT INTO scans (path, sha1, start_time, ingested, hosts) VALUES (?, ?, ?, ?, 0)",
+                                   (os.path.abspath(path), sha1, read_scan_start(path), time.time())).lastrowid
+            count = 0
+            for host in iter_nmap_xml(path):
+                for value, version in zip(host.address_ints, host.address_versions):
+                    host_id = conn.execute("INSERT INTO hosts (scan_id, address, version) VALUES (?, ?, ?)",
+                                           (scan_id, pack_address(value), version)).lastrowid
+                    conn.executemany("INSERT INTO hostnames VALUES (?, ?)", [(host_id, n) for n in host.hostnames])
+                    conn.executemany("INSERT INTO ports VALUES (?, ?)", [(host_id, p) for p in host.ports])
+                    conn.executemany("INSERT INTO hops VALUES (?, ?, ?, ?, ?)",
+                                     [(host_id, hop.index + 1, pack_address(hop.ipaddr_int), hop.version, hop.time_ms)
+                                      for hop in host.hops])
+                count += 1
+            conn.execute("UPDATE scans SET hosts = ? WHERE id = ?", (count, scan_id))
+        logger.info("Ingested %d hosts from %s in %0.2fs", count, path, time.time() - start)
+        return scan_id, True
+
+    def query(self, port=None, network=None, hop=None, hostname=None, since=None, until=None):
+        """
+        Find the hosts matching every given criterion, across all scans.
+
+        :param int port: An open port
+        :param str network: An address or CIDR the host address falls in
+        :param str hop: An address the host's route went through
+        :param str hostname: A host name
+        :param int since: Only scans started at or after this Unix time
+        :param int until: Only scans started before this Unix time
+        :return list: ``(address, start_time, scan_path, open_ports)`` tuples, newest scans first
+        """
+        joins, clauses, params = [], [], []
+        if port is not None:
+            joins.append("JOIN ports p ON p.host_id = h.id")
+            clauses.append("p.port = ?")
+            params.append(port)
+        if network is not None:
+            network = IPNetwork(network)
+            clauses.append("h.version = ? AND h.address BETWEEN ? AND ?")
+            params.extend([network.version, pack_address(network.first), pack_address(network.last)])
+        if hop is not None:
+            hop = IPAddress(hop)
+            joins.append("JOIN hops r ON r.host_id = h.id")
+            clauses.append("r.version = ? AND r.address = ?")
+            params.extend([hop.version, pack_address(int(hop))])
+        if hostname is not None:
+            joins.append("JOIN hostnames n ON n.host_id = h.id")
+            clauses.append("n.name = ?")
+            params.append(hostname)
+        if since is not None:
+            clauses.append("s.start_time >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("s.start_time < ?")
+            params.append(until)
+        sql = ("SELECT DISTINCT h.address, h.version, s.start_time, s.path, "
+               "(SELECT GROUP_CONCAT(port) FROM ports WHERE host_id = h.id) FROM hosts h "
+               "JOIN scans s ON h.scan_id = s.id " + " ".join(joins))
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        start = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(sql + " ORDER BY s.start_time DESC, h.version, h.address", params).fetchall()
+        results = [(unpack_address(address, version), start_time, path,
+                    [int(p) for p in ports.split(",")] if ports else [])
+                   for address, version, start_time, path, ports in rows]
+        logger.info("Query returned %d hosts in %0.1fms", len(results), (time.time() - start) * 1.0e3)
+        return results
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser("nmap scan index", formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-i", "--index", default=DEFAULT_INDEX_PATH, help="The path of the index database")
+    subparsers = ap.add_subparsers(dest="command")
+    ingest_ap = subparsers.add_parser("ingest", help="Add nmap XML files to the index")
+    ingest_ap.add_argument("xml_files", nargs="+", help="The paths of the .xml files")
+    query_ap = subparsers.add_parser("query", help="Query the hosts of every ingested scan")
+    query_ap.add_argument("-p", "--port", type=int, help="Only hosts with this port open")
+    query_ap.add_argument("-n", "--network", help="Only hosts in this address or CIDR")
+    query_ap.add_argument("-r", "--hop", help="Only hosts whose route went through this address")
+    query_ap.add_argument("-H", "--hostname", help="Only hosts with this name")
+    query_ap.add_argument("-s", "--since", type=parse_since, help="Only scans since this date, or e.g. 7d ago")
+    query_ap.add_argument("-u", "--until", type=parse_since, help="Only scans before this date, or e.g. 1d ago")
+    parser_ns = ap.parse_args(args)
+    index = NmapIndex(parser_ns.index)
+    if parser_ns.command == "ingest":
+        for xml_file in parser_ns.xml_files:
+            index.ingest(xml_file)
+        return
+    for address, start_time, path, ports in index.query(parser_ns.port, parser_ns.network, parser_ns.hop,
+                                                        parser_ns.hostname, parser_ns.since, parser_ns.until):
+        print "{0}\t{1}\t({2})\t{3}".format(address, datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M"),
+                                            ", ".join(str(p) for p in ports), path)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
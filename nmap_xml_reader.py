@@ -1,29 +1,52 @@
 #!/usr/bin/env python
+import glob
+import multiprocessing
+import socket
+import struct
 import sys
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser
+from array import array
 from lxml import etree
-from lxml.etree import XMLParser
 from total_ordering import total_ordering
 from netaddr import IPAddress
+import numpy as np
+
+LOW_MASK = (1 << 64) - 1
+IPV6_DTYPE = np.dtype([("high", np.uint64), ("low", np.uint64)])
+
+
+def ip_to_int(text):
+    """
+    :param str text: An IPv4 or IPv6 address
+    :return tuple: ``(value, version)``
+    """
+    if ":" in text:
+        high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, text))
+        return (high << 64) | low, 6
+    return struct.unpack("!I", socket.inet_aton(text))[0], 4
 
 
 @total_ordering
 class HopInfo(object):
+    """
+    A traceroute hop, with its address stored as an integer.
+    """
+    __slots__ = ("index", "ipaddr_int", "version", "time_ms")
 
-    def __init__(self, hop_elem):
-        self.element = hop_elem
-
-    @property
-    def ipaddr(self):
-        return IPAddress(self.element.get("ipaddr"))
+    def __init__(self, index, ipaddr_int, version, time_ms):
+        self.index = index
+        self.ipaddr_int = ipaddr_int
+        self.version = version
+        self.time_ms = time_ms
 
-    @property
-    def time_ms(self):
-        return float(self.element.get("rtt"))
+    @classmethod
+    def from_element(cls, hop_elem):
+        ipaddr_int, version = ip_to_int(hop_elem.get("ipaddr"))
+        return cls(int(hop_elem.get("ttl")) - 1, ipaddr_int, version, float(hop_elem.get("rtt", 0)))
 
     @property
-    def index(self):
-        return int(self.element.get("ttl")) - 1
+    def ipaddr(self):
+        return IPAddress(self.ipaddr_int, self.version)
 
     def __lt__(self, other):
         return (self.index, self.time_ms) < (other.index, other.time_ms)
@@ -39,27 +62,39 @@ class HopInfo(object):
 
 
 class HostInfo(object):
+    """
+    A host that is up, materialized from its ``<host>`` element in a single pass: the addresses are integers, the
+    open ports an ``array('H')`` and the hops a tuple sorted by TTL.
+    """
+    __slots__ = ("address_ints", "address_versions", "ports", "hostnames", "hops")
 
-    def __init__(self, host_elem):
-        self.element = host_elem
-
-    @property
-    def addresses(self):
-        return [IPAddress(e.get("addr")) for e in self.element.xpath("address")]
-
-    @property
-    def ports(self):
-        port_elems = self.element.xpath("ports/port[state[@state=\'open\']]")
-        return [int(e.get("portid")) for e in port_elems]
+    def __init__(self, address_ints, address_versions, ports, hostnames, hops):
+        self.address_ints = address_ints
+        self.address_versions = address_versions
+        self.ports = ports
+        self.hostnames = hostnames
+        self.hops = hops
 
-    @property
-    def hostnames(self):
-        return [e.get("name") for e in self.element.xpath("hostnames/hostname")]
+    @classmethod
+    def from_element(cls, host_elem):
+        addresses, ports, hostnames, hops = [], [], (), ()
+        for child in host_elem:
+            if child.tag == "address" and child.get("addrtype") in ("ipv4", "ipv6"):
+                addresses.append(ip_to_int(child.get("addr")))
+            elif child.tag == "hostnames":
+                hostnames = tuple(e.get("name") for e in child.iterchildren("hostname"))
+            elif child.tag == "ports":
+                ports = [int(e.get("portid")) for e in child.iterchildren("port")
+                         if e.find("state") is not None and e.find("state").get("state") == "open"]
+            elif child.tag == "trace":
+                hops = tuple(sorted(HopInfo.from_element(e) for e in child.iterchildren("hop")
+                                    if e.get("ipaddr")))
+        return cls(tuple(a[0] for a in addresses), tuple(a[1] for a in addresses), array("H", ports), hostnames,
+                   hops)
 
     @property
-    def hops(self):
-        hop_elems = self.element.xpath("trace/hop")
-        return sorted([HopInfo(elem) for elem in hop_elems])
+    def addresses(self):
+        return [IPAddress(value, version) for value, version in zip(self.address_ints, self.address_versions)]
 
     def __repr__(self):
         hostnames_str = ", ".join(self.hostnames)
@@ -79,35 +114,189 @@ class HostInfo(object):
         return repr(self)
 
 
+def iter_nmap_xml(xml_file):
+    """
+    Stream the hosts that are up out of an nmap XML file, in constant memory: each ``<host>`` element is converted
+    as soon as it is closed, then cleared along with everything parsed before it.
+
+    :param xml_file: The path of the file, or a file object
+    :return: An iterator of :class:`HostInfo`
+    """
+    for _, elem in etree.iterparse(xml_file, events=("end",), tag="host", recover=True, huge_tree=True):
+        status = elem.find("status")
+        if status is not None and status.get("state") == "up":
+            yield HostInfo.from_element(elem)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
 def parse_nmap_xml(xml_file):
-    with open(xml_file, "r") as f:
-        data = f.read()
-    tree = etree.fromstring(data, XMLParser(recover=True))
-    host_elems = tree.xpath("//host[status[@state=\'up\']]")
-    return [HostInfo(elem) for elem in host_elems]
+    return list(iter_nmap_xml(xml_file))
+
+
+def range_to_cidrs(first, last, bits):
+    """
+    Split an inclusive range of addresses into the fewest aligned CIDR blocks.
+
+    :param int bits: The address size (32 or 128)
+    :return: An iterator of ``(network, prefix_length)``
+    """
+    while first <= last:
+        alignment = (first & -first).bit_length() - 1 if first else bits
+        block_bits = min(alignment, (last - first + 1).bit_length() - 1)
+        yield first, bits - block_bits
+        first += 1 << block_bits
+
+
+class AddressSet(object):
+    """
+    A sorted, deduplicated set of addresses packed into NumPy arrays: ``uint32`` for IPv4, and pairs of ``uint64``
+    (a structured array sorting by the high then the low half) for IPv6.
+    """
+    __slots__ = ("ipv4", "ipv6")
+
+    def __init__(self, ipv4, ipv6):
+        self.ipv4 = np.unique(ipv4)
+        self.ipv6 = np.unique(ipv6)
+
+    @classmethod
+    def from_arrays(cls, ipv4, ipv6):
+        """
+        :param array ipv4: An ``array('I')`` of IPv4 addresses
+        :param list ipv6: ``(high, low)`` halves of IPv6 addresses
+        """
+        ipv4_dtype = np.dtype("=u{0}".format(ipv4.itemsize))
+        return cls(np.frombuffer(ipv4, dtype=ipv4_dtype).astype(np.uint32) if ipv4 else np.empty(0, np.uint32),
+                   np.array(ipv6, dtype=IPV6_DTYPE))
+
+    @classmethod
+    def merge(cls, address_sets):
+        address_sets = list(address_sets)
+        return cls(np.concatenate([s.ipv4 for s in address_sets] or [np.empty(0, np.uint32)]),
+                   np.concatenate([s.ipv6 for s in address_sets] or [np.empty(0, IPV6_DTYPE)]))
+
+    def __len__(self):
+        return len(self.ipv4) + len(self.ipv6)
+
+    def ipv6_ints(self):
+        return [(int(high) << 64) | int(low) for high, low in self.ipv6.tolist()]
+
+    def __iter__(self):
+        """
+        :return: An iterator of the addresses as strings, IPv4 first
+        """
+        pack = struct.Struct("!I").pack
+        for value in self.ipv4.tolist():
+            yield socket.inet_ntoa(pack(value))
+        for value in self.ipv6_ints():
+            yield str(IPAddress(value, 6))
+
+    def cidrs(self):
+        """
+        :return: An iterator of the minimal CIDR blocks covering exactly the addresses of the set, as strings
+        """
+        if len(self.ipv4):
+            breaks = np.flatnonzero(np.diff(self.ipv4.astype(np.int64)) != 1)
+            firsts = self.ipv4[np.concatenate(([0], breaks + 1))].tolist()
+            lasts = self.ipv4[np.concatenate((breaks, [len(self.ipv4) - 1]))].tolist()
+            for first, last in zip(firsts, lasts):
+                for network, prefix in range_to_cidrs(first, last, 32):
+                    yield "{0}/{1}".format(socket.inet_ntoa(struct.pack("!I", network)), prefix)
+        values = self.ipv6_ints()
+        start = 0
+        for i in xrange(1, len(values) + 1):
+            if i == len(values) or values[i] != values[i - 1] + 1:
+                for network, prefix in range_to_cidrs(values[start], values[i - 1], 128):
+                    yield "{0}/{1}".format(IPAddress(network, 6), prefix)
+                start = i
+
+
+def file_addresses(xml_file):
+    """
+    :return AddressSet: Every host and hop address in a file
+    """
+    ipv4, ipv6 = array("I"), []
+    for info in iter_nmap_xml(xml_file):
+        keys = zip(info.address_versions, info.address_ints)
+        keys.extend((hop.version, hop.ipaddr_int) for hop in info.hops)
+        for version, value in keys:
+            if version == 4:
+                ipv4.append(value)
+            else:
+                ipv6.append((value >> 64, value & LOW_MASK))
+    return AddressSet.from_arrays(ipv4, ipv6)
+
+
+def expand_paths(patterns):
+    """
+    Expand glob patterns (for shells that do not), keeping any pattern matching nothing as a plain path.
+    """
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def pool_size(xml_files, jobs=None):
+    """
+    :return int: The number of processes :func:`map_files` uses; 1 means the files are parsed in this process
+    """
+    return min(jobs or multiprocessing.cpu_count(), len(xml_files))
+
+
+def map_files(func, xml_files, jobs=None):
+    """
+    Apply ``func`` to every file, across a pool of ``jobs`` processes (one per core by default) when there are
+    several files. Only the compact results of ``func`` cross the process boundary, never lxml elements.
+
+    :return: An iterator of the results, in the order of ``xml_files``
+    """
+    jobs = pool_size(xml_files, jobs)
+    if jobs <= 1:
+        for xml_file in xml_files:
+            yield func(xml_file)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(func, xml_files):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 def parse_args(args):
     ap = ArgumentParser("nmap.xml Reader")
     ap.add_argument("-a", "--all", action="store_true", help="Print all information")
-    ap.add_argument("xml_file", type=FileType("r"), help="The path to the .xml file")
+    ap.add_argument("-c", "--cidr", action="store_true", help="Print the minimal list of CIDRs covering the addresses")
+    ap.add_argument("-j", "--jobs", type=int, default=None,
+                    help="The number of processes parsing files in parallel (one per core by default)")
+    ap.add_argument("xml_files", nargs="+", metavar="xml_file", help="The paths to (or globs of) the .xml files")
     parser_ns = ap.parse_args(args)
+    parser_ns.xml_files = expand_paths(parser_ns.xml_files)
     return parser_ns
 
 
 def main(args):
     parser_ns = parse_args(args)
-    host_infos = parse_nmap_xml(parser_ns.xml_file.name)
     if parser_ns.all:
-        print "\n".join([str(host_info) for host_info in host_infos])
+        seen = set()
+        if pool_size(parser_ns.xml_files, parser_ns.jobs) <= 1:
+            # stream the hosts, so that memory only grows with the set of addresses seen
+            file_hosts = (iter_nmap_xml(xml_file) for xml_file in parser_ns.xml_files)
+        else:
+            file_hosts = map_files(parse_nmap_xml, parser_ns.xml_files, parser_ns.jobs)
+        for host_infos in file_hosts:
+            for host_info in host_infos:
+                key = (host_info.address_versions, host_info.address_ints)
+                if key not in seen:
+                    seen.add(key)
+                    print host_info
     else:
-        addresses = set()
-        for info in host_infos:
-            addresses.update(info.addresses)
-            for hop in info.hops:
-                addresses.add(hop.ipaddr)
-        addresses = sorted(addresses)
-        print "\n".join([str(addr) for addr in addresses])
+        addresses = AddressSet.merge(map_files(file_addresses, parser_ns.xml_files, parser_ns.jobs))
+        for line in (addresses.cidrs() if parser_ns.cidr else addresses):
+            print line
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -1,52 +1,587 @@
 #!/usr/bin/env python
+from collections import deque, OrderedDict
+import heapq
+from itertools import islice
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import re
 import requests
 import sys
+import threading
+import time
 from datetime import datetime
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, ArgumentTypeError
 import logging
 
+from disk_cache import DiskCache
+import jar_classes
+import m2_index
+
 logging.basicConfig()
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.DEBUG)
 
 
+DOC_FIELDS = ("id", "g", "a", "v", "latestVersion", "p", "timestamp", "versionCount", "ec", "tags")
+TIMESTAMP_INDEX = DOC_FIELDS.index("timestamp")
+EXTRAS_INDEX = len(DOC_FIELDS)
+DOCS_ARRAY_RGX = re.compile(r'"docs"\s*:\s*\[')
+HEADER_RGXS = {"QTime": re.compile(r'"QTime"\s*:\s*(\d+)'),
+               "numFound": re.compile(r'"numFound"\s*:\s*(\d+)')}
+
+
+class DocTable(object):
+    """
+    A compact table of Maven docs, holding one tuple per doc (in :data:`DOC_FIELDS` order) instead of a dict.
+
+    Any other key of a doc, and any of its fields set to null, is kept in a dict at the end of the tuple (None when
+    there is none), so that :meth:`as_dict` gives back the doc as it was decoded.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, doc):
+        extras = dict((key, value) for key, value in doc.iteritems() if value is None or key not in DOC_FIELDS)
+        self.rows.append(tuple(doc.get(field) for field in DOC_FIELDS) + (extras or None,))
+
+    def by_timestamp(self):
+        """
+        :return: An iterator of the docs, newest first
+        """
+        return (self.as_dict(row) for row in sorted(self.rows, key=lambda row: row[TIMESTAMP_INDEX], reverse=True))
+
+    @staticmethod
+    def as_dict(row):
+        doc = dict((field, value) for field, value in zip(DOC_FIELDS, row) if value is not None)
+        if len(row) > EXTRAS_INDEX and row[EXTRAS_INDEX]:
+            doc.update(row[EXTRAS_INDEX])
+        return doc
+
+    def __iter__(self):
+        return (self.as_dict(row) for row in self.rows)
+
+
+def scan_header(text, header):
+    for key, rgx in HEADER_RGXS.items():
+        value_match = rgx.search(text)
+        if value_match is not None and key not in header:
+            header[key] = int(value_match.group(1))
+
+
+def iter_json_docs(chunks, header):
+    """
+    Incrementally decode the ``docs`` array of a Solr JSON response, one doc at a time, so that the whole response
+    never has to be held in memory at once.
+
+    :param chunks: An iterable of raw response chunks
+    :param dict header: Filled in with the ``QTime`` and ``numFound`` values found around the docs array
+    :return: An iterator of doc dicts
+    :raises ValueError: If the response has no docs array, or a doc cannot be decoded
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    match = None
+    for chunk in chunks:
+        buf += chunk
+        match = DOCS_ARRAY_RGX.search(buf)
+        if match is not None:
+            break
+    if match is None:
+        raise ValueError("No docs array in the response")
+    scan_header(buf[:match.start()], header)
+    buf = buf[match.end():]
+    while True:
+        buf = buf.lstrip(" \t\r\n,")
+        if buf.startswith("]"):
+            # anything following the docs array is small, so it can be scanned for values not found yet
+            scan_header("".join([buf] + list(chunks)), header)
+            return
+        try:
+            doc, end = decoder.raw_decode(buf)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buf += chunk
+            continue
+        yield doc
+        buf = buf[end:]
+
+
 class ResponseWrapper(object):
     """
     Wrapper for an HTTP response that contains the results of a Maven query.
+
+    The response is decoded only once, into a :class:`DocTable`. With ``stream=True`` (which needs a response
+    requested with ``stream=True`` as well) the docs are decoded incrementally as the body is read. A body that cannot
+    be decoded is logged and leaves the docs decoded so far, with the exception kept in ``error``.
     """
 
-    def __init__(self, response):
+    def __init__(self, response, stream=False, chunk_size=65536):
         self.response = response
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.header = None
+        self.docs = None
+        self.error = None
+
+    def decode(self):
+        if self.docs is not None:
+            return
+        self.header = {}
+        self.docs = DocTable()
+        try:
+            if self.stream:
+                for doc in iter_json_docs(self.response.iter_content(self.chunk_size), self.header):
+                    self.docs.append(doc)
+            else:
+                payload = self.response.json()
+                self.header["QTime"] = payload["responseHeader"]["QTime"]
+                self.header["numFound"] = payload["response"]["numFound"]
+                for doc in payload["response"]["docs"]:
+                    self.docs.append(doc)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.exception("Error decoding Maven response: %s", e)
+            self.error = e
+
+    @classmethod
+    def from_cache_entry(cls, entry):
+        """
+        Rebuild a decoded wrapper from an entry made by :meth:`to_cache_entry`, without any HTTP response.
+        """
+        wrapper = cls(None)
+        wrapper.header = dict(entry["header"])
+        wrapper.docs = DocTable()
+        wrapper.docs.rows = [tuple(row) for row in entry["rows"]]
+        return wrapper
+
+    @classmethod
+    def from_docs(cls, docs, total, query_time):
+        """
+        Build a decoded wrapper from docs that did not come from an HTTP response (e.g. from a local index).
+        """
+        wrapper = cls(None)
+        wrapper.header = {"QTime": query_time, "numFound": total}
+        wrapper.docs = DocTable()
+        for doc in docs:
+            wrapper.docs.append(doc)
+        return wrapper
+
+    def to_cache_entry(self):
+        self.decode()
+        return {"header": self.header, "rows": self.docs.rows}
 
     @property
     def total_time(self):
+        if self.response is None:
+            return 0.0
         return self.response.elapsed.seconds * 1.0e3 + self.response.elapsed.microseconds * 1e-3
 
     @property
     def query_time(self):
-        return self.response.json()['responseHeader']['QTime']
+        self.decode()
+        return self.header.get("QTime")
 
     @property
     def total(self):
-        return self.response.json()['response']['numFound']
+        self.decode()
+        return self.header.get("numFound", 0)
 
     def maven_docs(self):
+        """
+        :return list: The doc dicts, newest first
+        """
+        self.decode()
+        return list(self.docs.by_timestamp())
+
+    def latest_versions(self, docs=None):
+        """
+        Group the docs by ``(g, a)``, newest first.
+
+        :param list docs: The doc dicts from :meth:`maven_docs`, if they were already built
+        """
+        self.decode()
+        return group_latest_versions(docs if docs is not None else self.docs)
+
+
+class LatestVersions(object):
+    """
+    Single-pass aggregator keeping only the ``top_n`` newest docs of each ``(g, a)`` group in a bounded min-heap, so
+    memory grows with the number of groups times ``top_n`` rather than with the number of docs.
+    """
+
+    def __init__(self, top_n=None):
+        """
+        :param int top_n: The number of versions kept per group (at least 1), or None to keep them all
+        """
+        if top_n is not None and top_n < 1:
+            raise ValueError("top_n must be at least 1, not {0}".format(top_n))
+        self.top_n = top_n
+        self.heaps = {}
+        self.newest = {}
+        self.count = 0
+
+    def __len__(self):
+        return len(self.heaps)
+
+    def add(self, doc):
+        key = (doc['g'], doc['a'])
+        timestamp = doc.get('timestamp', 0)
+        self.count += 1
+        entry = (timestamp, self.count, doc)
+        heap = self.heaps.setdefault(key, [])
+        if self.top_n is None or len(heap) < self.top_n:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        if timestamp > self.newest.get(key, -1):
+            self.newest[key] = timestamp
+
+    def update(self, docs):
+        for doc in docs:
+            self.add(doc)
+        return self
+
+    def versions(self, key):
+        """
+        :return list: The kept docs of the ``key`` group, newest first
+        """
+        return [doc for _, _, doc in sorted(self.heaps[key], reverse=True)]
+
+    def ranked(self, limit=None):
+        """
+        :param int limit: The maximum number of groups to return, or None for all of them
+        :return list: ``(key, docs)`` pairs for the groups with the newest docs first, each with its docs newest first
+        """
+        if limit is None:
+            keys = sorted(self.newest, key=self.newest.get, reverse=True)
+        else:
+            keys = heapq.nlargest(limit, self.newest, key=self.newest.get)
+        return [(key, self.versions(key)) for key in keys]
+
+    def as_dict(self):
+        return dict((key, self.versions(key)) for key in self.heaps)
+
+    def docs(self):
+        """
+        :return list: Every kept doc, newest first
+        """
+        return [doc for _, _, doc in sorted((entry for heap in self.heaps.itervalues() for entry in heap),
+                                            reverse=True)]
+
+
+def group_latest_versions(docs, top_n=None):
+    return LatestVersions(top_n).update(docs).as_dict()
+
+
+class QueryCache(object):
+    """
+    A two-layer cache of decoded Maven responses: an in-memory LRU in front of a :class:`disk_cache.DiskCache`, both
+    keyed by the normalized query parameters and expiring after ``ttl`` seconds.
+
+    Identical queries that are in flight at the same time share a single request.
+    """
+
+    def __init__(self, ttl=3600.0, max_entries=64, bypass=False):
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.disk = DiskCache("query_maven", ttl=ttl, bypass=bypass)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "expired": 0}
+
+    def configure(self, ttl=None, bypass=None):
+        if ttl is not None:
+            self.disk.ttl = ttl
+        if bypass is not None:
+            self.disk.bypass = bypass
+
+    @staticmethod
+    def normalize(params):
+        query = params["q"]
+        if isinstance(query, unicode):
+            query = query.encode("utf-8")
+        return [" ".join(query.split()), int(params["rows"]), int(params["start"])]
+
+    def stats(self):
+        """
+        :return dict: The hit and miss counts of each layer, the number of coalesced requests and the hit ratio
+        """
+        with self.lock:
+            stats = dict(self.counts)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["memory_hits"] + stats["disk_hits"]) / float(lookups) if lookups else 0.0
+        stats["ttl"] = self.disk.ttl
+        return stats
+
+    def memory_get(self, key):
+        stored = self.memory.pop(key, None)
+        if stored is None or self.disk.bypass:
+            return None
+        if time.time() - stored[0] > self.disk.ttl:
+            self.counts["expired"] += 1
+            return None
+        self.memory[key] = stored
+        return stored[1]
+
+    def memory_set(self, key, value):
+        self.memory.pop(key, None)
+        self.memory[key] = (time.time(), value)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get_or_fetch(self, params, fetch):
+        """
+        Return the cached entry for ``params``, calling ``fetch()`` to make it if no layer holds a fresh copy.
+        """
+        key = tuple(self.normalize(params))
+        with self.lock:
+            value = self.memory_get(key)
+            if value is not None:
+                self.counts["memory_hits"] += 1
+                return value
+            flight = self.in_flight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.in_flight[key] = {"event": threading.Event()}
+            else:
+                self.counts["coalesced"] += 1
+        if not owner:
+            flight["event"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["value"]
         try:
-            return sorted(self.response.json()['response']['docs'], key=lambda d: d['timestamp'], reverse=True)
+            value = self.disk.get(list(key))
+            with self.lock:
+                self.counts["disk_hits" if value is not None else "misses"] += 1
+            if value is None:
+                value = self.disk.set(list(key), fetch())
+            with self.lock:
+                self.memory_set(key, value)
+            flight["value"] = value
+            return value
         except Exception as e:
-            return []
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight["event"].set()
 
-    def latest_versions(self):
-        docs = self.maven_docs()
-        latest_versions = {}
-        for doc in docs:
-            latest_versions.setdefault((doc['g'], doc['a']), []).append(doc)
-        return latest_versions
 
+QUERY_CACHE = QueryCache()
+
+
+class LocalIndexLookup(object):
+    """
+    Answers queries from the offline index of the local Maven repository (see :mod:`m2_index`), if one was built.
+
+    By default the index is only a fallback for when Maven Central cannot be reached, since it may not hold the newest
+    versions; with ``prefer`` it answers every query it has matches for without asking Maven Central at all.
+    """
+
+    def __init__(self, path=m2_index.DEFAULT_INDEX_PATH, enabled=True, prefer=False):
+        self.path = path
+        self.enabled = enabled
+        self.prefer = prefer
+
+    def fetch(self, search_term, num_rows, start):
+        """
+        :return: The decoded local results, or None if the index is disabled, missing, has no matches or cannot
+                 answer the query
+        :rtype: :class:`ResponseWrapper`
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        start_time = time.time()
+        try:
+            num_found, docs = m2_index.M2Index(self.path).search(search_term, num_rows, start)
+        except m2_index.UnsupportedQuery as e:
+            logger.debug("%s", e)
+            return None
+        if not num_found:
+            return None
+        logger.info("Answered %r from the local index (%d matches)", search_term, num_found)
+        return ResponseWrapper.from_docs(docs, num_found, int((time.time() - start_time) * 1.0e3))
+
+
+LOCAL_INDEX = LocalIndexLookup()
+
+
+def fetch_page(search_term, num_rows, start, stream=False, cache=QUERY_CACHE, local_index=LOCAL_INDEX):
+    """
+    Fetch and decode a single page of results for an already formatted query.
+
+    :param cache: The cache to look the page up in first, or None to always query Maven Central
+    :type cache: :class:`QueryCache`
+    :param local_index: The local repository index to answer from first if it is preferred, or when Maven Central
+                        cannot be reached; None to skip it
+    :type local_index: :class:`LocalIndexLookup`
+    :return: The decoded response
+    :rtype: :class:`ResponseWrapper`
+    :raises requests.HTTPError: If Maven Central answered with an error status
+    :raises Exception: The decoding error (ValueError, KeyError or TypeError) if the response could not be decoded;
+                       nothing is cached then
+    """
+    if local_index is not None and local_index.prefer:
+        local_page = local_index.fetch(search_term, num_rows, start)
+        if local_page is not None:
+            return local_page
+    query_url = "http://search.maven.org/solrsearch/select"
+    query_params = {"q": search_term, "rows": num_rows, "wt": "json", "start": start}
+
+    def fetch():
+        resp = requests.get(query_url, params=query_params, stream=stream)
+        resp.raise_for_status()
+        wrapper = ResponseWrapper(resp, stream)
+        wrapper.decode()
+        if wrapper.error is not None:
+            raise wrapper.error  # rather than caching a partial or empty page
+        return wrapper
+
+    try:
+        if cache is None:
+            return fetch()
+        return ResponseWrapper.from_cache_entry(cache.get_or_fetch(query_params, lambda: fetch().to_cache_entry()))
+    except requests.RequestException as e:
+        local_page = None
+        if local_index is not None and not local_index.prefer:
+            local_page = local_index.fetch(search_term, num_rows, start)
+        if local_page is None:
+            raise
+        logger.warning("Maven Central query failed (%s), falling back to the local index, which may miss the newest "
+                       "versions", e)
+        return local_page
+
+
+class MavenPager(object):
+    """
+    Iterates over every doc matching a query, fetching the pages after the first one concurrently.
+
+    The first page tells how many docs there are in total; the rest are requested by a pool of ``jobs`` threads, with
+    at most ``2 * jobs`` pages in flight, and yielded in page order so memory stays flat.
+    """
+
+    def __init__(self, search_term, num_rows, start=0, jobs=4, stream=False, limit=None):
+        """
+        :param int limit: The maximum number of docs to fetch, or None to fetch every match
+        """
+        self.search_term = search_term
+        self.num_rows = num_rows
+        self.start = start
+        self.jobs = jobs
+        self.stream = stream
+        self.limit = limit
+        self.total = None
+        self.query_time = 0
+        self.pages = 0
 
-def query_maven(search_term, num_rows, start, class_name=False, class_path=False):
+    def fetch(self, start):
+        return fetch_page(self.search_term, self.num_rows, start, self.stream)
+
+    def add_page(self, wrapper, page_start):
+        self.pages += 1
+        self.query_time += wrapper.query_time or 0
+        return list(islice(wrapper.docs, max(0, self.end - page_start)))
+
+    @property
+    def end(self):
+        if self.limit is None:
+            return self.total
+        return min(self.total, self.start + self.limit)
+
+    def iter_pages(self):
+        """
+        :return: An iterator of doc lists, one per page, in page order
+        """
+        first_page = self.fetch(self.start)
+        self.total = first_page.total
+        yield self.add_page(first_page, self.start)
+        page_starts = iter(xrange(self.start + self.num_rows, self.end, self.num_rows))
+        pool = ThreadPool(self.jobs)
+        try:
+            pending = deque((page_start, pool.apply_async(self.fetch, (page_start,)))
+                            for page_start in islice(page_starts, self.jobs * 2))
+            while pending:
+                page_start, result = pending.popleft()
+                wrapper = result.get()
+                for next_start in islice(page_starts, 1):
+                    pending.append((next_start, pool.apply_async(self.fetch, (next_start,))))
+                yield self.add_page(wrapper, page_start)
+                logger.info("Fetched %d pages, %d still pending", self.pages, len(pending))
+        finally:
+            pool.terminate()
+
+    def __iter__(self):
+        for docs in self.iter_pages():
+            for doc in docs:
+                yield doc
+
+
+def write_json_lines(docs, f):
+    """
+    Write each doc to ``f`` as a line of JSON.
+
+    :return int: The number of docs written
+    """
+    count = 0
+    for doc in docs:
+        f.write(json.dumps(doc, sort_keys=True))
+        f.write("\n")
+        count += 1
+    return count
+
+
+def resolve_jar_classes(jar_path, num_rows=64, jobs=8):
+    """
+    Find the Maven artifacts that provide the classes of a local jar.
+
+    The class names are read from the jar's central directory and collapsed to their packages; one ``fc:`` search is
+    then run per package (using one of its classes), concurrently and without repeating identical queries.
+
+    :param str jar_path: The path to the jar
+    :param int num_rows: The maximum number of results per class search
+    :param int jobs: The maximum number of concurrent searches
+    :return tuple: ``(ranked, total_classes)``, where ``ranked`` lists the candidate ``g:a:v`` coordinates with the
+                   number of classes they cover, best coverage first
+    """
+    packages = jar_classes.group_by_package(jar_classes.jar_class_names(jar_path))
+    total_classes = sum(len(names) for names in packages.values())
+    queries = sorted(set("fc:\"{0}\"".format(names[0]) for names in packages.values()))
+    logger.info("Resolving %d classes in %d packages from %s", total_classes, len(packages), jar_path)
+    pool = ThreadPool(max(1, min(jobs, len(queries))))
+    try:
+        pages = pool.map(lambda query: fetch_page(query, num_rows, 0), queries)
+    finally:
+        pool.close()
+        pool.join()
+    coverage = {}
+    timestamps = {}
+    for query, page in zip(queries, pages):
+        package = query[len("fc:\""):-1].rpartition(".")[0]
+        for doc in page.docs:
+            coordinate = "{0}:{1}:{2}".format(doc["g"], doc["a"], doc.get("v", doc.get("latestVersion")))
+            coverage.setdefault(coordinate, set()).add(package)
+            timestamps[coordinate] = max(timestamps.get(coordinate, 0), doc.get("timestamp", 0))
+    ranked = [(gav, sum(len(packages[p]) for p in covered)) for gav, covered in coverage.items()]
+    ranked.sort(key=lambda (gav, count): (count, timestamps[gav]), reverse=True)
+    logger.info("Found %d candidate artifacts for %d classes", len(ranked), total_classes)
+    return ranked, total_classes
+
+
+def query_maven(search_term, num_rows, start, class_name=False, class_path=False, stream=False):
     """
     Query Maven Central with the given parameters.
+
+    :param bool stream: True to decode the docs incrementally while the response is read
     """
     if class_path:
         search_format = "\"fc:{0}\""
@@ -55,17 +590,22 @@ def query_maven(search_term, num_rows, start, class_name=False, class_path=False
     else:
         search_format = "{0}"
     search_term = search_format.format(search_term)
-    query_url = "http://search.maven.org/solrsearch/select"
-    query_params = {"q": search_term, "rows": num_rows, "wt": "json", "start": start}
-    resp = requests.get(query_url, params=query_params)
-    wrapper = ResponseWrapper(resp)
+    wrapper = fetch_page(search_term, num_rows, start, stream)
     logger.info("Maven query took %0.0f ms", wrapper.total_time)
-    return {"docs": wrapper.maven_docs(),
-            "latest": wrapper.latest_versions(),
+    docs = wrapper.maven_docs()
+    return {"docs": docs,
+            "latest": wrapper.latest_versions(docs),
             "total": wrapper.total,
             "query_time": wrapper.query_time}
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError("{0!r} is not a positive number".format(value))
+    return number
+
+
 def parse_args(args):
     """
     Parse the given list of arguments and return the resulting parser namespace.
@@ -82,7 +622,31 @@ def parse_args(args):
                     help="Enable exact Java classpath searches")
     ap.add_argument("-c", "--class-name", action="store_true", default=False,
                     help="Enable searches by Java class name")
-    ap.add_argument("-o", "--output", help="The output file - default is stdout", default=None)
+    ap.add_argument("-J", "--jar", action="store_true", default=False,
+                    help="Treat the search term as the path to a local jar, "
+                         "and rank the artifacts providing its classes")
+    ap.add_argument("-S", "--stream", action="store_true", default=False,
+                    help="Decode the response incrementally, which keeps very large pages out of memory")
+    ap.add_argument("-A", "--all-pages", action="store_true", default=False,
+                    help="Fetch every page of results, starting at --start, instead of a single page")
+    ap.add_argument("-j", "--jobs", type=positive_int, default=4,
+                    help="The maximum number of pages fetched concurrently with --all-pages, or searches with --jar")
+    ap.add_argument("-V", "--top-versions", type=positive_int, default=None,
+                    help="Only keep the newest N versions of each artifact - default is all of them")
+    ap.add_argument("-o", "--output", default=None,
+                    help="Write the docs to this file as JSON lines instead of printing the latest versions")
+    ap.add_argument("-t", "--cache-ttl", type=float, default=3600.0,
+                    help="The number of seconds cached query results stay fresh")
+    ap.add_argument("-N", "--no-cache", action="store_true", default=False,
+                    help="Ignore cached query results (fresh results are still cached)")
+    ap.add_argument("-R", "--remote-only", action="store_true", default=False,
+                    help="Never fall back to the local repository index (built by m2_index) when Maven Central cannot "
+                         "be reached")
+    ap.add_argument("-L", "--local-first", action="store_true", default=False,
+                    help="Answer from the local repository index whenever it has matches, without querying Maven "
+                         "Central, which may hide newer versions")
+    ap.add_argument("--cache-stats", action="store_true", default=False,
+                    help="Log the query cache statistics when done")
     ap.add_argument("search_term")
     parser_ns = ap.parse_args(args)
     return parser_ns
@@ -90,17 +654,54 @@ def parse_args(args):
 
 def main(args):
     parser_ns = parse_args(args)
+    QUERY_CACHE.configure(ttl=parser_ns.cache_ttl, bypass=parser_ns.no_cache)
+    LOCAL_INDEX.enabled = not parser_ns.remote_only
+    LOCAL_INDEX.prefer = parser_ns.local_first
+    try:
+        return run_query(parser_ns)
+    finally:
+        if parser_ns.cache_stats:
+            logger.info("Query cache statistics: %r", QUERY_CACHE.stats())
+
+
+def format_search_term(parser_ns):
     if parser_ns.class_path:
-        search_term = "fc:\"{0}\"".format(parser_ns.search_term)
+        return "fc:\"{0}\"".format(parser_ns.search_term)
     elif parser_ns.class_name:
-        search_term = "c:\"{0}\"".format(parser_ns.search_term)
+        return "c:\"{0}\"".format(parser_ns.search_term)
+    return parser_ns.search_term
+
+
+def run_query(parser_ns):
+    if parser_ns.jar:
+        ranked, total = resolve_jar_classes(parser_ns.search_term, parser_ns.num_rows, parser_ns.jobs)
+        for coordinate, count in ranked:
+            print "{0}: {1}/{2} classes ({3:0.1f}%)".format(coordinate, count, total, 100.0 * count / max(total, 1))
+        return ranked
+    search_term = format_search_term(parser_ns)
+    if parser_ns.all_pages:
+        pager = MavenPager(search_term, parser_ns.num_rows, parser_ns.start, parser_ns.jobs, parser_ns.stream)
+        if parser_ns.output:
+            with open(parser_ns.output, "w") as f:
+                written = write_json_lines(pager, f)
+            logger.info("Wrote %d of %d docs to %s", written, pager.total, parser_ns.output)
+            return {"total": pager.total, "written": written, "query_time": pager.query_time}
+        # the docs are pushed into the bounded heaps page by page, as they are fetched
+        latest = LatestVersions(parser_ns.top_versions).update(pager)
+        maven_dict = {"docs": latest.docs(),
+                      "total": pager.total,
+                      "query_time": pager.query_time}
     else:
-        search_term = parser_ns.search_term
-    maven_dict = query_maven(search_term, parser_ns.num_rows, parser_ns.start)
-    docs_by_key = maven_dict['latest'].items()
-    docs_by_key.sort(key=lambda (k, vs): max([v['timestamp'] for v in vs]), reverse=True)
-    logger.info("Maven Central found %d matches (%d unique!)", maven_dict['total'], len(docs_by_key))
-    for key, docs in docs_by_key:
+        maven_dict = query_maven(search_term, parser_ns.num_rows, parser_ns.start, stream=parser_ns.stream)
+        if parser_ns.output:
+            with open(parser_ns.output, "w") as f:
+                written = write_json_lines(maven_dict["docs"], f)
+            logger.info("Wrote %d of %d docs to %s", written, maven_dict["total"], parser_ns.output)
+            return maven_dict
+        latest = LatestVersions(parser_ns.top_versions).update(maven_dict["docs"])
+    maven_dict["latest"] = latest.as_dict()
+    logger.info("Maven Central found %d matches (%d unique!)", maven_dict['total'], len(latest))
+    for key, docs in latest.ranked():
         print "{0[0]} - {0[1]}:".format(key)
         for doc in docs:
             version = doc.get('v', doc.get('latestVersion'))
@@ -1,11 +1,14 @@
 from PyQt4.QtGui import QHBoxLayout, QWidget, QLayout, QSpacerItem, \
     QLayoutItem, QVBoxLayout, QPushButton, QApplication, QLabel, QSpinBox, \
-    QCheckBox, QLineEdit
-from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, Qt
-import pprint
+    QCheckBox, QLineEdit, QTableView, QAbstractItemView
+from PyQt4.QtCore import pyqtSlot as Slot, pyqtSignal as Signal, Qt, \
+    QAbstractTableModel, QModelIndex, QThread
+from datetime import datetime
 import query_maven
 import sys
 
+PAGE_SIZE = 128
+
 
 class QHL(QHBoxLayout):
 
@@ -68,9 +71,97 @@ def find_child(name):
     return next((w for w in app.allWidgets() if w.objectName() == name), None)
 
 
+class DocTableModel(QAbstractTableModel):
+    """
+    Table model over the docs of a Maven query, which grows a page at a time as results arrive.
+    """
+
+    HEADERS = ('Group', 'Artifact', 'Version', 'Updated')
+
+    def __init__(self, parent=None):
+        super(DocTableModel, self).__init__(parent)
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return self.rows[index.row()][index.column()]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+    @staticmethod
+    def to_row(doc):
+        updated = datetime.fromtimestamp(doc.get('timestamp', 0) / 1000.)
+        return (doc['g'], doc['a'], doc.get('v', doc.get('latestVersion', '')),
+                updated.strftime('%Y-%m-%d %H:%M'))
+
+    def append_docs(self, docs):
+        if not docs:
+            return
+        rows = [self.to_row(doc) for doc in docs]
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+
+class QueryWorker(QThread):
+    """
+    Runs a Maven query off the GUI thread, emitting each page of docs as soon as it arrives.
+    """
+
+    page_ready = Signal(object, int)
+    query_failed = Signal(str)
+
+    def __init__(self, parser_ns, parent=None):
+        super(QueryWorker, self).__init__(parent)
+        self.parser_ns = parser_ns
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        ns = self.parser_ns
+        pager = query_maven.MavenPager(query_maven.format_search_term(ns),
+                                       min(PAGE_SIZE, ns.num_rows), ns.start,
+                                       jobs=ns.jobs, limit=ns.num_rows)
+        pages = pager.iter_pages()
+        try:
+            for docs in pages:
+                if self.cancelled:
+                    break
+                self.page_ready.emit(docs, pager.total)
+        except Exception as e:
+            self.query_failed.emit('{0}: {1}'.format(e.__class__.__name__, e))
+        finally:
+            pages.close()
+
+
 def run_query(*args, **kwargs):
     print "run_query(args: {0!r}, kwargs: {1!r})".format(args, kwargs)
     tlw = args[0].topLevelWidget()
+    button = find_child('run_query_qpb')
+    status = find_child('status_ql')
+    worker = getattr(tlw, 'query_worker', None)
+    if worker is not None and worker.isRunning():
+        worker.cancel()
+        status.setText('Query cancelled')
+        return
 
     query_args = ['-n', str(find_child('max_results_qsb').value()),
                   '-s', str(find_child('start_index_qsb').value())]
@@ -81,12 +172,41 @@ def run_query(*args, **kwargs):
     query = str(find_child('search_term_qle').text())
     query_args.append(query)
     print "Query args: {0!r}".format(query_args)
-    pprint.pprint(query_maven.main(query_args))
+
+    model = find_child('results_qtv').model()
+    model.clear()
+    worker = QueryWorker(query_maven.parse_args(query_args), parent=tlw)
+
+    def show_page(docs, total):
+        if worker.cancelled:
+            return
+        model.append_docs(docs)
+        status.setText('Showing {0} of {1} matches'.format(model.rowCount(), total))
+
+    def show_error(message):
+        status.setText('Query failed: {0}'.format(message))
+
+    def query_finished():
+        button.setText('OK')
+        if tlw.query_worker is worker:
+            tlw.query_worker = None
+
+    worker.page_ready.connect(show_page)
+    worker.query_failed.connect(show_error)
+    worker.finished.connect(query_finished)
+    tlw.query_worker = worker
+    button.setText('Stop')
+    status.setText('Querying...')
+    worker.start()
 
 
 def close_window(*args, **kwargs):
     print "close_window(args: {0!r}, kwargs: {1!r})".format(args, kwargs)
     tlw = args[0].topLevelWidget()
+    worker = getattr(tlw, 'query_worker', None)
+    if worker is not None:
+        worker.cancel()
+        worker.wait()
     tlw.close()
 
 
@@ -132,9 +252,16 @@ def main():
             QButton(text='Cancel',
                     onClick=close_window,
                     objectName='close_window_qpb')
-        ])
+        ]),
+        QLabel(text='', objectName='status_ql'),
+        QTableView(objectName='results_qtv')
     ])
     w.setLayout(main_layout)
+    results_view = find_child('results_qtv')
+    results_view.setModel(DocTableModel(results_view))
+    results_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    results_view.verticalHeader().setDefaultSectionSize(20)
+    results_view.horizontalHeader().setStretchLastSection(True)
     w.setWindowFlags(Qt.WindowStaysOnTopHint)
     w.setWindowModality(Qt.ApplicationModal)
     w.show()
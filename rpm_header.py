@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Minimal reader for the lead, signature and header sections of RPM package files.
+
+An RPM file is laid out as a 96-byte lead, a signature header padded to a multiple of 8 bytes, the main header and
+finally the compressed payload. Both headers share the same structure: a 16-byte intro (magic, reserved bytes,
+index entry count and data store size), the index entries (16 bytes each) and then the data store.
+"""
+import hashlib
+import logging
+import struct
+import sys
+import threading
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+import requests
+
+logger = logging.getLogger(__name__)
+
+LEAD_SIZE = 96
+LEAD_MAGIC = "\xed\xab\xee\xdb"
+HEADER_MAGIC = "\x8e\xad\xe8\x01"
+HEADER_INTRO_SIZE = 16
+INDEX_ENTRY_SIZE = 16
+
+# Signature header tags
+SIGTAG_SIZE = 1000
+SIGTAG_MD5 = 1004
+SIGTAG_PAYLOADSIZE = 1007
+SIGTAG_SHA1 = 269
+SIGTAG_SHA256 = 273
+
+# Main header tags
+TAG_NAME = 1000
+TAG_VERSION = 1001
+TAG_RELEASE = 1002
+TAG_EPOCH = 1003
+TAG_SUMMARY = 1004
+TAG_SIZE = 1009
+TAG_ARCH = 1022
+TAG_PROVIDENAME = 1047
+TAG_REQUIRENAME = 1049
+
+# Index entry data types
+TYPE_NULL, TYPE_CHAR, TYPE_INT8, TYPE_INT16, TYPE_INT32, TYPE_INT64, TYPE_STRING, TYPE_BIN, TYPE_STRING_ARRAY, \
+    TYPE_I18NSTRING = range(10)
+INT_FORMATS = {TYPE_CHAR: "B", TYPE_INT8: "B", TYPE_INT16: "H", TYPE_INT32: "I", TYPE_INT64: "Q"}
+
+
+class RpmFormatError(Exception):
+    """
+    Raised when data does not look like a valid RPM lead or header.
+    """
+
+
+def header_size(intro):
+    """
+    Return the total size of a header section (intro, index entries and data store) from its 16-byte intro.
+
+    :param str intro: At least the first 16 bytes of the header section
+    :return int: The size of the whole header section, in bytes
+    """
+    if intro[:4] != HEADER_MAGIC:
+        raise RpmFormatError("Bad header magic: {0!r}".format(intro[:4]))
+    index_count, store_size = struct.unpack(">II", intro[8:16])
+    return HEADER_INTRO_SIZE + index_count * INDEX_ENTRY_SIZE + store_size
+
+
+def signature_padding(size):
+    """
+    :param int size: The size of the signature header section
+    :return int: The number of padding bytes following it, which align the main header to 8 bytes
+    """
+    return (8 - size % 8) % 8
+
+
+def parse_header(data):
+    """
+    Parse a header section into a dictionary of tag numbers to values.
+
+    Integer types become lists of ints, strings become ``str``, string arrays become lists of ``str`` and binary
+    entries stay as raw byte strings.
+
+    :param str data: The complete header section, starting with its magic
+    :return dict: The decoded tags
+    """
+    if len(data) < header_size(data):
+        raise RpmFormatError("Truncated header: {0} of {1} bytes".format(len(data), header_size(data)))
+    index_count, store_size = struct.unpack(">II", data[8:16])
+    store_start = HEADER_INTRO_SIZE + index_count * INDEX_ENTRY_SIZE
+    store = data[store_start:store_start + store_size]
+    tags = {}
+    for i in xrange(index_count):
+        entry_start = HEADER_INTRO_SIZE + i * INDEX_ENTRY_SIZE
+        tag, data_type, offset, count = struct.unpack(">IIII", data[entry_start:entry_start + INDEX_ENTRY_SIZE])
+        if data_type in INT_FORMATS:
+            fmt = ">{0}{1}".format(count, INT_FORMATS[data_type])
+            tags[tag] = list(struct.unpack(fmt, store[offset:offset + struct.calcsize(fmt)]))
+        elif data_type == TYPE_BIN:
+            tags[tag] = store[offset:offset + count]
+        elif data_type == TYPE_STRING:
+            tags[tag] = store[offset:store.index("\0", offset)]
+        elif data_type in (TYPE_STRING_ARRAY, TYPE_I18NSTRING):
+            values = []
+            for _ in xrange(count):
+                end = store.index("\0", offset)
+                values.append(store[offset:end])
+                offset = end + 1
+            tags[tag] = values[0] if data_type == TYPE_I18NSTRING and count == 1 else values
+    return tags
+
+
+class RpmLayout(object):
+    """
+    The byte offsets of the sections of an RPM file, computed from as few leading bytes as possible.
+    """
+
+    def __init__(self, signature_size, header_size):
+        self.signature_size = signature_size
+        self.header_size = header_size
+
+    @property
+    def signature_start(self):
+        return LEAD_SIZE
+
+    @property
+    def header_start(self):
+        return LEAD_SIZE + self.signature_size + signature_padding(self.signature_size)
+
+    @property
+    def payload_start(self):
+        return self.header_start + self.header_size
+
+    @staticmethod
+    def signature_size_from(data):
+        """
+        :param str data: At least the first ``LEAD_SIZE + HEADER_INTRO_SIZE`` bytes of the file
+        :return int: The size of the signature header section
+        """
+        if data[:4] != LEAD_MAGIC:
+            raise RpmFormatError("Bad lead magic: {0!r}".format(data[:4]))
+        return header_size(data[LEAD_SIZE:LEAD_SIZE + HEADER_INTRO_SIZE])
+
+    @classmethod
+    def from_prefix(cls, data):
+        """
+        Build the layout from the leading bytes of an RPM file. Enough bytes to reach the main header's intro are
+        needed; :meth:`required_prefix` tells how many that is.
+        """
+        signature_size = cls.signature_size_from(data)
+        header_start = LEAD_SIZE + signature_size + signature_padding(signature_size)
+        return cls(signature_size, header_size(data[header_start:header_start + HEADER_INTRO_SIZE]))
+
+    @classmethod
+    def required_prefix(cls, data):
+        """
+        :param str data: At least the first ``LEAD_SIZE + HEADER_INTRO_SIZE`` bytes of the file
+        :return int: The number of leading bytes needed by :meth:`from_prefix`
+        """
+        signature_size = cls.signature_size_from(data)
+        return LEAD_SIZE + signature_size + signature_padding(signature_size) + HEADER_INTRO_SIZE
+
+
+def read_rpm_headers(f):
+    """
+    Read the layout, signature tags and main header tags from the start of an open RPM file.
+
+    :return tuple: ``(layout, signature_tags, header_tags)``
+    """
+    prefix = f.read(LEAD_SIZE + HEADER_INTRO_SIZE)
+    prefix += f.read(RpmLayout.required_prefix(prefix) - len(prefix))
+    layout = RpmLayout.from_prefix(prefix)
+    prefix += f.read(layout.payload_start - len(prefix))
+    signature = parse_header(prefix[layout.signature_start:layout.signature_start + layout.signature_size])
+    header = parse_header(prefix[layout.header_start:layout.payload_start])
+    return layout, signature, header
+
+
+def verify_rpm_digest(path, chunk_size=1 << 20):
+    """
+    Verify an RPM file against the digests stored in its own signature header: the SHA-256 or SHA-1 digest of the
+    main header and the MD5 digest of the main header plus payload.
+
+    :param str path: The path to the RPM file
+    :return: True if every digest present matches, False if any mismatches and None if there were no digests
+    :rtype: bool or None
+    """
+    with open(path, "rb") as f:
+        layout, signature, _ = read_rpm_headers(f)
+        f.seek(layout.header_start)
+        header_data = f.read(layout.header_size)
+        md5 = hashlib.md5(header_data)
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            md5.update(chunk)
+    checks = []
+    if SIGTAG_SHA256 in signature:
+        checks.append(hashlib.sha256(header_data).hexdigest() == signature[SIGTAG_SHA256])
+    elif SIGTAG_SHA1 in signature:
+        checks.append(hashlib.sha1(header_data).hexdigest() == signature[SIGTAG_SHA1])
+    if SIGTAG_MD5 in signature:
+        checks.append(md5.digest() == signature[SIGTAG_MD5])
+    return all(checks) if checks else None
+
+
+class RpmInfo(object):
+    """
+    The metadata decoded from the headers of an RPM file.
+    """
+
+    def __init__(self, url, header, file_size=None, bytes_fetched=None):
+        self.url = url
+        self.name = header.get(TAG_NAME)
+        self.epoch = header.get(TAG_EPOCH, [None])[0]
+        self.version = header.get(TAG_VERSION)
+        self.release = header.get(TAG_RELEASE)
+        self.arch = header.get(TAG_ARCH)
+        self.summary = header.get(TAG_SUMMARY)
+        self.installed_size = header.get(TAG_SIZE, [None])[0]
+        self.requires = sorted(set(header.get(TAG_REQUIRENAME, [])))
+        self.provides = sorted(set(header.get(TAG_PROVIDENAME, [])))
+        self.file_size = file_size
+        self.bytes_fetched = bytes_fetched
+
+    @property
+    def nevra(self):
+        epoch = "{0}:".format(self.epoch) if self.epoch else ""
+        return "{0.name}-{1}{0.version}-{0.release}.{0.arch}".format(self, epoch)
+
+    def __repr__(self):
+        return "{0} ({1} bytes, {2} installed, {3} bytes fetched)".format(self.nevra, self.file_size,
+                                                                          self.installed_size, self.bytes_fetched)
+
+
+class HeaderFetcher(object):
+    """
+    Reads the lead, signature and header sections of remote RPM files with HTTP range requests, without downloading
+    their payloads.
+    """
+
+    def __init__(self, initial_size=16384, timeout=(5, 21)):
+        """
+        :param int initial_size: The number of leading bytes requested first, which covers the lead, the signature
+                                 and the start of the main header for most packages
+        """
+        self.initial_size = initial_size
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers["User-Agent"] = "Mozilla/5.0"
+        return self.local.session
+
+    def fetch_range(self, url, start, end):
+        resp = self.session().get(url, headers={"Range": "bytes={0}-{1}".format(start, end)}, timeout=self.timeout)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise RpmFormatError("{0} does not support range requests".format(url))
+        file_size = int(resp.headers.get("Content-Range", "/0").rsplit("/", 1)[-1] or 0) or None
+        return resp.content, file_size
+
+    def fetch(self, url):
+        """
+        :param str url: The URL of an RPM file
+        :return: The decoded metadata
+        :rtype: :class:`RpmInfo`
+        """
+        data, file_size = self.fetch_range(url, 0, self.initial_size - 1)
+        needed = RpmLayout.required_prefix(data)
+        if needed > len(data):
+            data += self.fetch_range(url, len(data), needed - 1)[0]
+        layout = RpmLayout.from_prefix(data)
+        if layout.payload_start > len(data):
+            data += self.fetch_range(url, len(data), layout.payload_start - 1)[0]
+        return RpmInfo(url, parse_header(data[layout.header_start:layout.payload_start]), file_size, len(data))
+
+    def fetch_quietly(self, url):
+        try:
+            return self.fetch(url)
+        except (requests.RequestException, RpmFormatError, struct.error, ValueError) as e:
+            logger.warning("Unable to read the RPM header of %s: %s", url, e)
+            return None
+
+    def fetch_all(self, urls, jobs=8):
+        """
+        Fetch the headers of many RPM files concurrently.
+
+        :param list urls: The URLs of the RPM files
+        :param int jobs: The maximum number of concurrent requests
+        :return: A list of :class:`RpmInfo` objects (or None for the ones that failed), in the order of ``urls``
+        """
+        pool = ThreadPool(max(1, min(jobs, len(urls))))
+        try:
+            return pool.map(self.fetch_quietly, urls)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def main(args):
+    ap = ArgumentParser("RPM header reader")
+    ap.add_argument("rpm_file", help="The path or URL of the .rpm file")
+    parser_ns = ap.parse_args(args)
+    if "://" in parser_ns.rpm_file:
+        info = HeaderFetcher().fetch(parser_ns.rpm_file)
+        print repr(info)
+        print "\tRequires: {0}".format(", ".join(info.requires))
+        print "\tProvides: {0}".format(", ".join(info.provides))
+        return
+    with open(parser_ns.rpm_file, "rb") as f:
+        layout, _, header = read_rpm_headers(f)
+    print "{0}-{1}-{2}.{3}".format(header[TAG_NAME], header[TAG_VERSION], header[TAG_RELEASE], header[TAG_ARCH])
+    print "\tHeader bytes: {0}".format(layout.payload_start)
+    print "\tDigest check: {0}".format(verify_rpm_digest(parser_ns.rpm_file))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Search RPM repositories through their ``repodata/primary.xml.gz`` metadata.
+
+The primary metadata is parsed with a streaming ``iterparse`` (each ``<package>`` element is cleared as soon as it
+has been read, so memory stays constant) and stored in a local SQLite index. Later searches only hit the index.
+"""
+import bz2
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import urlparse
+import zlib
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import deque
+from contextlib import closing
+from lxml import etree
+from path import Path
+import requests
+
+from disk_cache import CACHE_ROOT
+
+if not logging.root.handlers:
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s')
+logger = logging.getLogger('rpm_repodata')
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_INDEX_PATH = CACHE_ROOT.joinpath('rpm_repodata.db')
+REPO_NS = 'http://linux.duke.edu/metadata/repo'
+COMMON_NS = 'http://linux.duke.edu/metadata/common'
+GLOB_CHARS = set('*?[')
+GLOB_CHARS_RGX = re.compile(r'[*?[]')
+
+
+class DecompressingStream(object):
+    """
+    A minimal read-only file object that decompresses another (possibly non-seekable) stream on the fly.
+    """
+
+    def __init__(self, fileobj, decompressor, chunk_size=1 << 16):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.chunk_size = chunk_size
+        self.chunks = deque()
+        self.offset = 0  # into the first chunk
+        self.buffered = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.buffered < size:
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            data = self.decompressor.decompress(chunk)
+            if data:
+                self.chunks.append(data)
+                self.buffered += len(data)
+        if size < 0:
+            size = self.buffered
+        parts = []
+        while size > 0 and self.chunks:
+            head = self.chunks[0]
+            part = head[self.offset:self.offset + size]
+            parts.append(part)
+            size -= len(part)
+            self.buffered -= len(part)
+            self.offset += len(part)
+            if self.offset >= len(head):
+                self.chunks.popleft()
+                self.offset = 0
+        return ''.join(parts)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def open_metadata(location):
+    """
+    Open a (possibly compressed) metadata file from a local path or URL as a streaming file object.
+
+    :param str location: The path or URL of the metadata file
+    :return: A readable file object yielding the uncompressed XML
+    """
+    if urlparse.urlparse(location).scheme in ('http', 'https', 'ftp'):
+        resp = requests.get(location, stream=True, timeout=(5, 60))
+        resp.raise_for_status()
+        resp.raw.decode_content = False
+        fileobj = resp.raw
+    else:
+        fileobj = open(location, 'rb')
+    if location.endswith('.gz'):
+        return DecompressingStream(fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    if location.endswith('.bz2'):
+        return DecompressingStream(fileobj, bz2.BZ2Decompressor())
+    return fileobj
+
+
+def glob_bounds(pattern):
+    """
+    :return tuple: The ``(lower, upper)`` bounds of the names a glob can match, taken from its literal prefix, or None
+                   when it starts with a wildcard
+    """
+    prefix = GLOB_CHARS_RGX.split(pattern, 1)[0]
+    if not prefix:
+        return None
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def join_location(base, href):
+    if urlparse.urlparse(base).scheme:
+        return urlparse.urljoin(base.rstrip('/') + '/', href)
+    return os.path.join(base, href)
+
+
+def find_primary(source):
+    """
+    Resolve a repository source into the location of its primary metadata and the base used for package locations.
+
+    :param str source: A repository base (path or URL), or the path or URL of the primary metadata itself
+    :return tuple: ``(primary_location, repository_base)``
+    """
+    if '.xml' in os.path.basename(source):
+        return source, os.path.dirname(os.path.dirname(source.rstrip('/')))
+    repomd = join_location(source, 'repodata/repomd.xml')
+    with closing(open_metadata(repomd)) as f:
+        tree = etree.parse(f)
+    href = tree.xpath('//r:data[@type="primary"]/r:location/@href', namespaces={'r': REPO_NS})
+    if not href:
+        raise ValueError('No primary metadata listed in {0}'.format(repomd))
+    return join_location(source, href[0]), source
+
+
+def iter_packages(fileobj):
+    """
+    Stream the packages out of a primary metadata file.
+
+    :return: An iterator of ``(name, epoch, version, release, arch, location_href)`` tuples
+    """
+    package_tag = '{{{0}}}package'.format(COMMON_NS)
+    name_tag, arch_tag, version_tag, location_tag = ['{{{0}}}{1}'.format(COMMON_NS, t)
+                                                     for t in ('name', 'arch', 'version', 'location')]
+    for _, elem in etree.iterparse(fileobj, events=('end',), tag=package_tag):
+        version = elem.find(version_tag)
+        location = elem.find(location_tag)
+        yield (elem.findtext(name_tag), version.get('epoch'), version.get('ver'), version.get('rel'),
+               elem.findtext(arch_tag), location.get('href'))
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class RepodataIndex(object):
+    """
+    A persistent SQLite index of the packages in one or more repositories.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = Path(path)
+        if not self.path.dirname().exists():
+            self.path.dirname().makedirs()
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, source TEXT UNIQUE, base TEXT,
+                                                ingested REAL, packages INTEGER);
+            CREATE TABLE IF NOT EXISTS packages (source_id INTEGER, name TEXT, epoch TEXT, version TEXT,
+                                                 release TEXT, arch TEXT, location TEXT);
+            CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.conn.close()
+        return False  # propagate any exceptions
+
+    def source_id(self, source):
+        row = self.conn.execute('SELECT id FROM sources WHERE source = ?', (source,)).fetchone()
+        return row[0] if row else None
+
+    def ingest(self, source, refresh=False, batch_size=2048):
+        """
+        Add the packages of a repository to the index, unless it was already ingested.
+
+        :param str source: A repository base or primary metadata location (see :func:`find_primary`)
+        :param bool refresh: True to re-ingest a repository that is already in the index
+        :return int: The ID of the source in the index
+        """
+        existing_id = self.source_id(source)
+        if existing_id is not None and not refresh:
+            return existing_id
+        start = time.time()
+        primary, base = find_primary(source)
+        logger.info('Ingesting %s...', primary)
+        with self.conn:
+            if existing_id is not None:
+                self.conn.execute('DELETE FROM packages WHERE source_id = ?', (existing_id,))
+                self.conn.execute('DELETE FROM sources WHERE id = ?', (existing_id,))
+            cursor = self.conn.execute('INSERT INTO sources (source, base, ingested, packages) VALUES (?, ?, ?, 0)',
+                                       (source, base, time.time()))
+            source_id = cursor.lastrowid
+            count = 0
+            batch = []
+            with closing(open_metadata(primary)) as f:
+                for package in iter_packages(f):
+                    batch.append((source_id,) + package)
+                    if len(batch) >= batch_size:
+                        self.conn.executemany('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                        count += len(batch)
+                        batch = []
+            self.conn.executemany('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            count += len(batch)
+            self.conn.execute('UPDATE sources SET packages = ? WHERE id = ?', (count, source_id))
+        logger.info('Indexed %d packages in %0.3fs', count, time.time() - start)
+        return source_id
+
+    def search(self, query, sources=None):
+        """
+        Search the index by package name. Queries containing glob characters are matched as globs, anything else
+        matches as a name prefix. The literal prefix of the pattern is turned into a range on the name index, so only
+        globs starting with a wildcard (e.g. ``*devel*``) scan the whole table.
+
+        :param str query: The search term or glob
+        :param list sources: Only search these sources (all of them by default)
+        :return: A list of ``(name, epoch, version, release, arch, location)`` tuples, where the location is a full
+                 path or URL
+        """
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        pattern = query if GLOB_CHARS & set(query) else query + '*'
+        sql = ('SELECT p.name, p.epoch, p.version, p.release, p.arch, s.base, p.location '
+               'FROM packages p JOIN sources s ON p.source_id = s.id WHERE p.name GLOB ?')
+        params = [pattern]
+        bounds = glob_bounds(pattern)
+        if bounds is not None:
+            # SQLite only uses the index for a GLOB against a literal, not a bound parameter
+            sql += ' AND p.name >= ? AND p.name < ?'
+            params.extend(bounds)
+        if sources:
+            sql += ' AND s.source IN ({0})'.format(', '.join('?' * len(sources)))
+            params.extend(sources)
+        start = time.time()
+        rows = self.conn.execute(sql, params).fetchall()
+        logger.info('Index query for %r returned %d packages in %0.1fms', query, len(rows),
+                    (time.time() - start) * 1.0e3)
+        return [row[:5] + (join_location(row[5], row[6]),) for row in rows]
+
+
+def search_repodata(query, sources, refresh=False, index_path=DEFAULT_INDEX_PATH):
+    """
+    Search the given repositories for packages, ingesting any of them that are not in the index yet.
+
+    :return dict: A mapping of RPM file names to the set of their locations, like :class:`search_rpms.SearchWrapper`
+    """
+    rpm_dict = {}
+    with RepodataIndex(index_path) as index:
+        for source in sources:
+            index.ingest(source, refresh)
+        for package in index.search(query, sources):
+            location = package[-1]
+            rpm_dict.setdefault(os.path.basename(urlparse.urlparse(location).path), set()).add(location)
+    return rpm_dict
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser(prog='rpm_repodata',
+                        description='Search RPM repositories through their primary metadata.',
+                        formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument('-r', '--repo', action='append', required=True,
+                    help='A repository base or primary.xml.gz location (path or URL); may be repeated')
+    ap.add_argument('-f', '--refresh', action='store_true', default=False,
+                    help='Re-ingest the repositories even if they are already indexed')
+    ap.add_argument('-i', '--index', default=DEFAULT_INDEX_PATH, help='The path of the index database')
+    ap.add_argument('query', help='The package name to search for (prefix or glob)')
+    ns = ap.parse_args(args)
+    rpm_dict = search_repodata(ns.query, ns.repo, ns.refresh, ns.index)
+    for file_name, locations in sorted(rpm_dict.items()):
+        print file_name, len(locations)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -12,10 +12,14 @@ import sys
 import urllib2
 import urlparse
 from lxml.html import etree, HTMLParser
-from sh import aria2c
 import retrying
 from path import Path
 
+from disk_cache import DiskCache
+import rpm_header
+import rpm_repodata
+import segmented_download
+
 if not logging.root.handlers:
     logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s')
 logger = logging.getLogger('search_rpms')
@@ -40,9 +44,28 @@ class TimeoutContext(object):
 
 class SearchWrapper(object):
 
-    def __init__(self, search_term):
+    def __init__(self, search_term, cache=None):
         self.search_term = search_term
         self.session = requests.Session()
+        self.cache = cache
+
+    def cached_page_links(self, page=1):
+        """
+        Return the match count and RPM links of a search page, from the cache if it holds a fresh copy.
+
+        :param int page: The page number
+        :return tuple: ``(count, links)``
+        """
+        key = ['pbone', self.search_term, page]
+        entry = self.cache.get(key) if self.cache is not None else None
+        if entry is None:
+            tree = self.search_rpm_page(page)
+            entry = {'count': self.parse_count(tree), 'links': self.extract_rpm_links(tree)}
+            if self.cache is not None:
+                self.cache.set(key, entry)
+        else:
+            logger.info('Using cached links for page %d of %r', page, self.search_term)
+        return entry['count'], entry['links']
 
     def __enter__(self):
         return self
@@ -93,25 +116,45 @@ class SearchWrapper(object):
         return sorted(set(links))
 
     @staticmethod
-    def parse_rpm_links(tree, rpm_dict=None):
-        links = tree.xpath('//div/table//a/@href')
-        rpm_dict = rpm_dict or {}
+    def extract_rpm_links(tree):
+        return tree.xpath('//div/table//a/@href')
+
+
+class RpmLinkAccumulator(object):
+    """
+    Incrementally merges RPM links across search pages, keyed by file name.
+
+    Links to ``<name>.rpm.html`` detail pages are redundant once ``<name>.rpm`` itself has been seen, so they are
+    held as pending entries until either the matching RPM shows up (and they are dropped) or the search ends (and
+    each of them is shown as a full link). Each page is merged in time proportional to its own number of links.
+    """
+
+    def __init__(self):
+        self.mapping = {}
+        self.pending_html = {}
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def add_links(self, links):
         for link in links:
             pr = urlparse.urlparse(link)
-            file_name = os.path.basename(pr.path)
-            rpm_dict.setdefault(file_name, set()).add(pr.geturl())
-        # remove redundant HTML entries
-        for fname, flinks in rpm_dict.items():
-            if os.path.splitext(fname)[-1] == '.rpm':
-                rpm_html = '{0}.html'.format(fname)
-                rpm_dict.pop(rpm_html, None)
-        # show any HTML entries left over as full links
-        for fname, flinks in rpm_dict.items():
-            if os.path.splitext(fname)[-1] == '.html':
-                rpm_dict.pop(fname)
-                for flink in flinks:
-                    rpm_dict[flink] = set([flink])
-        return rpm_dict
+            self.add_link(os.path.basename(pr.path), pr.geturl())
+
+    def add_link(self, file_name, url):
+        ext = os.path.splitext(file_name)[-1]
+        if ext == '.html':
+            rpm_name = file_name[:-len(ext)]
+            if rpm_name in self.mapping and os.path.splitext(rpm_name)[-1] == '.rpm':
+                return
+            self.pending_html.setdefault(file_name, set()).add(url)
+            # show any HTML entries as full links until the matching RPM is found
+            self.mapping[url] = set([url])
+            return
+        if ext == '.rpm':
+            for html_url in self.pending_html.pop('{0}.html'.format(file_name), ()):
+                self.mapping.pop(html_url, None)
+        self.mapping.setdefault(file_name, set()).add(url)
 
 
 def _split_dotted(dstr):
@@ -160,7 +203,12 @@ def _find_valid_file(mirror_file, mirror_data):
     return valid_file
 
 
-def find_valid_mirrors(mirrors):
+def find_valid_mirrors(mirrors, cache=None):
+    key = ['mirrors', sorted(mirrors)]
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        logger.info('Using cached mirror validation')
+        return cached
     valid_file = None
     for mirror in mirrors:
         mpr = urlparse.urlparse(mirror)._asdict()
@@ -184,19 +232,60 @@ def find_valid_mirrors(mirrors):
         mpr = urlparse.urlparse(m)._asdict()
         mpr['path'] = Path(mpr['path']).dirname().joinpath(valid_file)
         mirrors[i] = urlparse.ParseResult(**mpr).geturl()
+    if cache is not None:
+        cache.set(key, mirrors)
     return mirrors
 
 
-def do_download(mirrors):
+def do_download(mirrors, checksum=None, cache=None):
     mirrors = sorted(mirrors) if not isinstance(mirrors, list) else mirrors
     logger.info('List of mirrors: %s', mirrors)
-    valid_mirrors = find_valid_mirrors(mirrors)
+    valid_mirrors = find_valid_mirrors(mirrors, cache)
+    if not valid_mirrors:
+        return None
     name = valid_mirrors[0]
     logger.info('Downloading %s...', name)
-    for line in aria2c(valid_mirrors, _iter_noblock=True):
-        if isinstance(line, basestring):
-            sys.stdout.write(line)
-            sys.stdout.flush()
+    return segmented_download.download_file(valid_mirrors, checksum=checksum)
+
+
+def inspect_rpms(rpm_dict, jobs=8):
+    """
+    Print the metadata of every RPM in ``rpm_dict``, read from its header through HTTP range requests instead of
+    downloading it.
+
+    :param dict rpm_dict: The mapping of RPM file names to their mirror URLs
+    :param int jobs: The maximum number of concurrent header requests
+    """
+    candidates = []
+    for file_name, mirrors in sorted(rpm_dict.items(), key=name_key):
+        http_mirrors = sorted(m for m in mirrors if urlparse.urlparse(m).scheme in ('http', 'https'))
+        if http_mirrors:
+            candidates.append((file_name, http_mirrors[0]))
+    logger.info('Inspecting the headers of %d RPMs...', len(candidates))
+    infos = rpm_header.HeaderFetcher().fetch_all([url for _, url in candidates], jobs)
+    fetched = 0
+    for (file_name, url), info in zip(candidates, infos):
+        if info is None:
+            print '{0}: unavailable'.format(file_name)
+            continue
+        fetched += info.bytes_fetched
+        print '{0!r}'.format(info)
+        print '\tRequires: {0}'.format(', '.join(info.requires))
+        print '\tProvides: {0}'.format(', '.join(info.provides))
+    logger.info('Fetched %d header bytes for %d RPMs', fetched, len(candidates))
+
+
+def search_pbone(query, cache=None):
+    links = RpmLinkAccumulator()
+    with SearchWrapper(query, cache) as sw:
+        count, page_links = sw.cached_page_links()
+        num_pages = (count / 100) + bool(count % 100)
+        logger.info('Found %d matches', count)
+        links.add_links(page_links)
+        for index in xrange(2, num_pages + 1):
+            logger.info('Getting page %d/%d of results...', index, num_pages)
+            links.add_links(sw.cached_page_links(index)[1])
+    return links.mapping
 
 
 def main(args=None):
@@ -206,23 +295,37 @@ def main(args=None):
         description='Search rpm.pbone.net for RPMs matching a given query.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
+    ap.add_argument('-c', '--checksum', default=None,
+                    help='The expected checksum of the download, as algorithm:hexdigest '
+                         '(the RPM header digests are checked otherwise)')
+    ap.add_argument('-r', '--repo', action='append', default=None,
+                    help='Search the primary metadata of this repository (base or primary.xml.gz path or URL) '
+                         'instead of rpm.pbone.net; may be repeated')
+    ap.add_argument('-f', '--refresh', action='store_true', default=False,
+                    help='Re-ingest the --repo metadata even if it is already indexed')
+    ap.add_argument('-i', '--inspect', action='store_true', default=False,
+                    help='Show the name, version, size, requires and provides of each match, read from its RPM header')
+    ap.add_argument('-j', '--jobs', type=int, default=8,
+                    help='The maximum number of concurrent header requests for --inspect')
+    ap.add_argument('-t', '--cache-ttl', type=float, default=3600.0,
+                    help='The number of seconds cached search results and mirror checks stay fresh')
+    ap.add_argument('-n', '--no-cache', action='store_true', default=False,
+                    help='Ignore cached search results and mirror checks (fresh results are still cached)')
     ap.add_argument('query', help='The query to search for')
     ns = ap.parse_args(args)
     logger.info('Searching for %s...', ns.query)
-    rpm_dict = {}
-    with SearchWrapper(ns.query) as sw:
-        page = sw.search_rpm_page()
-        count = sw.parse_count(page)
-        num_pages = (count / 100) + bool(count % 100)
-        logger.info('Found %d matches', count)
-        rpm_dict = sw.parse_rpm_links(page, rpm_dict)
-        for index in xrange(2, num_pages + 1):
-            logger.info('Getting page %d/%d of results...', index, num_pages)
-            page = sw.search_rpm_page(index)
-            rpm_dict = sw.parse_rpm_links(page, rpm_dict)
-    if len(rpm_dict) == 1:
+    cache = DiskCache('search_rpms', ttl=ns.cache_ttl, bypass=ns.no_cache)
+    if ns.repo:
+        rpm_dict = rpm_repodata.search_repodata(ns.query, ns.repo, ns.refresh)
+    else:
+        rpm_dict = search_pbone(ns.query, cache)
+    if ns.inspect:
+        inspect_rpms(rpm_dict, ns.jobs)
+        return
+    local_paths = [p for ps in rpm_dict.values() for p in ps if not urlparse.urlparse(p).scheme]
+    if len(rpm_dict) == 1 and not local_paths:
         mirrors = rpm_dict.values()[0]
-        do_download(mirrors)
+        do_download(mirrors, ns.checksum, cache)
     else:
         print('List of matching RPMs:')
         for k, v in sorted(rpm_dict.items(), key=name_key):
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Segmented multi-mirror HTTP downloader.
+
+The file is split into byte ranges which are fetched from every usable mirror at once and written straight into a
+preallocated destination file. Mirrors that fall far behind the fastest one are retired, and whatever is left of
+their current range goes back into the shared queue for the faster mirrors to pick up.
+"""
+import hashlib
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import urlparse
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from Queue import Queue, Empty
+import requests
+
+import rpm_header
+
+if not logging.root.handlers:
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s')
+logger = logging.getLogger('segmented_download')
+logger.setLevel(logging.DEBUG)
+
+
+class DownloadError(Exception):
+    """
+    Raised when a download cannot be completed or fails its integrity check.
+    """
+
+
+class MirrorState(object):
+    """
+    Throughput bookkeeping for a single mirror.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+        self.retired = False
+
+    @property
+    def speed(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return "{0.url} ({1:0.1f} KiB/s, {0.bytes} bytes, {0.failures} failures)".format(self, self.speed / 1024)
+
+
+class SegmentedDownloader(object):
+
+    def __init__(self, mirrors, dest_path, segment_size=1 << 20, connections_per_mirror=2, slow_ratio=0.2,
+                 max_failures=3, timeout=(5, 21), chunk_size=1 << 16):
+        """
+        :param list mirrors: The URLs of the mirrors, which should all serve the same file
+        :param str dest_path: The path of the file to write
+        :param int segment_size: The size of each byte range handed out to a mirror
+        :param int connections_per_mirror: The number of concurrent range requests per mirror
+        :param float slow_ratio: Mirrors slower than this fraction of the fastest mirror's speed are retired
+        :param int max_failures: Mirrors failing this many requests are retired
+        """
+        self.mirrors = [MirrorState(url) for url in mirrors]
+        self.dest_path = dest_path
+        self.segment_size = segment_size
+        self.connections_per_mirror = connections_per_mirror
+        self.slow_ratio = slow_ratio
+        self.max_failures = max_failures
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.size = None
+        self.remaining = 0
+        self.segments = Queue()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers["User-Agent"] = "Mozilla/5.0"
+        return self.local.session
+
+    def probe(self):
+        """
+        Ask every mirror for the file size and whether it honors range requests, retiring the ones that do not or
+        that disagree with the majority about the size.
+
+        :return int: The size of the file
+        """
+        sizes = {}
+        for mirror in self.mirrors:
+            try:
+                resp = self.session().get(mirror.url, headers={"Range": "bytes=0-0"}, stream=True,
+                                          timeout=self.timeout)
+                resp.close()
+                content_range = resp.headers.get("Content-Range", "")
+                if resp.status_code != 206 or "/" not in content_range:
+                    raise DownloadError("range requests are not supported (HTTP {0})".format(resp.status_code))
+                sizes[mirror] = int(content_range.rsplit("/", 1)[-1])
+            except (requests.RequestException, DownloadError, ValueError) as e:
+                logger.warning("Skipping mirror %s: %s", mirror.url, e)
+                mirror.retired = True
+        if not sizes:
+            raise DownloadError("None of the mirrors support range requests")
+        size_votes = sorted(sizes.values(), key=sizes.values().count, reverse=True)
+        self.size = size_votes[0]
+        for mirror, size in sizes.items():
+            if size != self.size:
+                logger.warning("Skipping mirror %s: size %d != %d", mirror.url, size, self.size)
+                mirror.retired = True
+        return self.size
+
+    @property
+    def active_mirrors(self):
+        return [m for m in self.mirrors if not m.retired]
+
+    def is_slow(self, mirror):
+        if mirror.seconds < 1.0 or len(self.active_mirrors) < 2:
+            return False
+        best_speed = max(m.speed for m in self.active_mirrors)
+        return mirror.speed < best_speed * self.slow_ratio
+
+    def retire(self, mirror, reason, force=False):
+        with self.lock:
+            if not mirror.retired and (force or len(self.active_mirrors) > 1):
+                logger.warning("Retiring mirror %s: %s", mirror.url, reason)
+                mirror.retired = True
+
+    def fetch_segment(self, mirror, f, start, end):
+        """
+        Fetch the inclusive byte range ``[start, end]`` from ``mirror`` into ``f``.
+
+        The first offset not yet written is kept in ``self.local.position``, so that the rest of the range can be
+        handed back to the queue if the mirror fails or is retired halfway through.
+        """
+        self.local.position = start
+        headers = {"Range": "bytes={0}-{1}".format(start, end)}
+        resp = self.session().get(mirror.url, headers=headers, stream=True, timeout=self.timeout)
+        try:
+            if resp.status_code != 206:
+                raise DownloadError("HTTP {0} for range {1}-{2}".format(resp.status_code, start, end))
+            f.seek(start)
+            position = start
+            last_time = time.time()
+            for chunk in resp.iter_content(self.chunk_size):
+                chunk = chunk[:end + 1 - position]
+                f.write(chunk)
+                position += len(chunk)
+                self.local.position = position
+                now = time.time()
+                with self.lock:
+                    mirror.bytes += len(chunk)
+                    mirror.seconds += now - last_time
+                    self.remaining -= len(chunk)
+                last_time = now
+                if position > end:
+                    break
+                if mirror.retired or self.is_slow(mirror):
+                    self.retire(mirror, "too slow")
+                    if mirror.retired:
+                        break
+        finally:
+            resp.close()
+
+    def worker(self, mirror):
+        with open(self.dest_path, "r+b") as f:
+            while not mirror.retired and self.remaining > 0:
+                try:
+                    start, end = self.segments.get(timeout=0.1)
+                except Empty:
+                    continue
+                try:
+                    self.fetch_segment(mirror, f, start, end)
+                except (requests.RequestException, DownloadError) as e:
+                    mirror.failures += 1
+                    logger.warning("Error fetching %d-%d from %s: %s", start, end, mirror.url, e)
+                    if mirror.failures >= self.max_failures:
+                        self.retire(mirror, "too many failures", force=True)
+                finally:
+                    if self.local.position <= end:
+                        self.segments.put((self.local.position, end))
+
+    def download(self):
+        """
+        Download the file into :attr:`dest_path`.
+
+        :return str: The destination path
+        """
+        if self.size is None:
+            self.probe()
+        with open(self.dest_path, "wb") as f:
+            f.truncate(self.size)
+        self.remaining = self.size
+        for start in xrange(0, self.size, self.segment_size):
+            self.segments.put((start, min(start + self.segment_size, self.size) - 1))
+        threads = []
+        for mirror in self.active_mirrors:
+            for _ in xrange(self.connections_per_mirror):
+                thread = threading.Thread(target=self.worker, args=(mirror,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        start_time = time.time()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1.0)
+            done = self.size - self.remaining
+            logger.info("%5.1f%% (%d/%d bytes) at %0.1f KiB/s", 100.0 * done / max(self.size, 1), done, self.size,
+                        done / 1024.0 / max(time.time() - start_time, 1e-3))
+        for mirror in self.mirrors:
+            logger.info("Mirror %r", mirror)
+        if self.remaining > 0:
+            raise DownloadError("Every mirror failed with {0} bytes left".format(self.remaining))
+        return self.dest_path
+
+    def verify(self, checksum=None):
+        """
+        Verify the downloaded file against ``checksum`` (in the form ``algorithm:hexdigest``), or against the digests
+        in its own RPM signature header if no checksum was given and the file is an RPM. A file failing the check is
+        moved aside to ``<dest_path>.corrupt``, so it cannot be mistaken for a good download.
+
+        :raises DownloadError: If the file does not match, or its RPM headers cannot be read
+        """
+        if checksum:
+            algorithm, expected = checksum.split(":", 1)
+            digest = hashlib.new(algorithm)
+            with open(self.dest_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), ""):
+                    digest.update(chunk)
+            valid = digest.hexdigest().lower() == expected.lower()
+        elif self.dest_path.endswith(".rpm"):
+            try:
+                valid = rpm_header.verify_rpm_digest(self.dest_path)
+            except (rpm_header.RpmFormatError, struct.error) as e:
+                self.discard()
+                raise DownloadError("Unable to read the RPM headers of {0}: {1}".format(self.dest_path, e))
+        else:
+            valid = None
+        if valid is None:
+            logger.warning("No checksum available for %s, skipping verification", self.dest_path)
+        elif not valid:
+            self.discard()
+            raise DownloadError("Integrity check failed for {0}".format(self.dest_path))
+        else:
+            logger.info("Integrity check passed for %s", self.dest_path)
+        return valid
+
+    def discard(self):
+        corrupt_path = self.dest_path + ".corrupt"
+        if os.path.exists(corrupt_path):
+            os.remove(corrupt_path)
+        os.rename(self.dest_path, corrupt_path)
+        logger.warning("Moved the corrupt download to %s", corrupt_path)
+
+
+def download_file(mirrors, dest_path=None, checksum=None, **kwargs):
+    """
+    Download a file from several mirrors at once and verify it.
+
+    :param list mirrors: The mirror URLs for the file
+    :param str dest_path: The destination path, which defaults to the file name in the current directory
+    :param str checksum: An optional ``algorithm:hexdigest`` checksum
+    :return str: The destination path
+    """
+    dest_path = dest_path or os.path.basename(urlparse.urlparse(mirrors[0]).path)
+    downloader = SegmentedDownloader(mirrors, dest_path, **kwargs)
+    downloader.download()
+    downloader.verify(checksum)
+    return dest_path
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    ap = ArgumentParser(prog='segmented_download',
+                        description='Download a file from several mirrors at once.',
+                        formatter_class=ArgumentDefaultsHelpFormatter)
+    ap.add_argument('-o', '--output', default=None, help='The output path - default is the name in the first URL')
+    ap.add_argument('-c', '--checksum', default=None, help='The expected checksum, as algorithm:hexdigest')
+    ap.add_argument('-s', '--segment-size', type=int, default=1 << 20, help='The size of each byte range')
+    ap.add_argument('-n', '--connections', type=int, default=2, help='The number of connections per mirror')
+    ap.add_argument('mirrors', nargs='+', help='The mirror URLs')
+    ns = ap.parse_args(args)
+    download_file(ns.mirrors, ns.output, ns.checksum, segment_size=ns.segment_size,
+                  connections_per_mirror=ns.connections)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
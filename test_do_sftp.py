@@ -0,0 +1,73 @@
+"""
+Batch uploads of :mod:`do_sftp` against :mod:`fake_sftp`, a local stand-in for the sftp client.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import do_sftp
+
+FAKE_SFTP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_sftp.py")
+FAKE_SFTP_VARIABLES = ("FAKE_SFTP_PASSWORD", "FAKE_SFTP_EXIT_AFTER")
+
+
+class BatchUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_environ = dict((name, os.environ.get(name)) for name in FAKE_SFTP_VARIABLES)
+        os.environ["FAKE_SFTP_PASSWORD"] = "secret"
+        os.environ.pop("FAKE_SFTP_EXIT_AFTER", None)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.dest_dir = os.path.join(self.tmp_dir, "dest")
+        os.makedirs(os.path.join(self.source_dir, "sub"))
+        for index, rel_path in enumerate(["a.txt", "b.txt", os.path.join("sub", "c.txt")]):
+            with open(os.path.join(self.source_dir, rel_path), "wb") as f:
+                f.write("x" * (index + 1) * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def upload(self, password="secret", sessions=2):
+        transfers, remote_dirs = do_sftp.collect_tree(self.source_dir, self.dest_dir)
+        return do_sftp.batch_upload([sys.executable, FAKE_SFTP, "user@host"], transfers, password, sessions,
+                                    remote_dirs)
+
+    def test_success(self):
+        transfers, statuses = self.upload()
+        self.assertEqual(statuses, [0, 0])
+        self.assertEqual([t.error for t in transfers], [None, None, None])
+        for transfer in transfers:
+            with open(transfer.dest_file, "rb") as f:
+                self.assertEqual(len(f.read()), transfer.size)
+
+    def test_wrong_password(self):
+        transfers, statuses = self.upload(password="wrong")
+        self.assertEqual(statuses, [255, 255])
+        self.assertTrue(all(t.error is not None for t in transfers))
+        self.assertFalse(os.path.exists(self.dest_dir))
+
+    def test_session_dropped_mid_batch(self):
+        os.environ["FAKE_SFTP_EXIT_AFTER"] = "1"
+        transfers, statuses = self.upload(sessions=1)
+        self.assertEqual(statuses, [1])
+        # the largest file goes first and is confirmed; the one in flight and the one never sent both fail
+        confirmed = [t for t in transfers if t.error is None]
+        self.assertEqual([t.size for t in confirmed], [300])
+        self.assertEqual(len([t for t in transfers if t.error is not None]), 2)
+
+    def test_main_exit_status(self):
+        args = ["--sftp", FAKE_SFTP, "-u", "user", "-r", "localhost", "-t", self.source_dir, "-d", self.dest_dir]
+        self.assertEqual(do_sftp.main(args + ["-p", "wrong"]), 1)
+        self.assertEqual(do_sftp.main(args + ["-p", "secret"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
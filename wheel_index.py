@@ -0,0 +1,229 @@
+"""
+A structured index of binary distribution file names (wheels and ``bdist_wininst`` installers).
+
+Every file name is parsed once into its name, version, build, Python tag, ABI tag and platform. Compressed tag sets
+(e.g. ``py2.py3``) are expanded so that compatibility questions such as "everything for cp27 on win_amd64" or "the
+newest version of X for each Python" are answered by indexed SQLite lookups instead of title substring tests.
+"""
+import ast
+import logging
+import os
+import re
+import sqlite3
+import urlparse
+from collections import namedtuple
+from distutils.version import LooseVersion
+from lxml.html import etree, HTMLParser
+import requests
+
+logger = logging.getLogger(__name__)
+
+WHEEL_RGX = re.compile(r"^(?P<name>[^-]+)-(?P<version>[^-]+)(?:-(?P<build>[0-9][^-]*))?"
+                       r"-(?P<py_tag>[^-]+)-(?P<abi_tag>[^-]+)-(?P<platform>[^-]+)[.]whl$")
+INSTALLER_RGX = re.compile(r"^(?P<name>.+?)-(?P<version>[0-9][^-]*?)[.](?P<platform>win32|win-amd64)"
+                           r"(?:-py(?P<py_version>[0-9][.][0-9]+))?[.](?:exe|msi)$")
+JS_CALL_RGX = re.compile("javascript:dl[(](?P<char_codes>\\S+)\\s+\"(?P<encoded_link>[^\"]+)\"[)]")
+LINK_XPATH = "//a[@href][@onclick][@title]"
+FIELDS = ("name", "version", "build", "py_tag", "abi_tag", "platform")
+ARCH_PLATFORMS = {"32": "win32", "64": "win_amd64"}
+
+
+class WheelFile(namedtuple("WheelFile", FIELDS + ("filename", "url"))):
+    """
+    The parsed fields of a distribution file; the tags may be compressed tag sets such as ``py2.py3``.
+    """
+    __slots__ = ()
+
+    @property
+    def tags(self):
+        """
+        :return list: The expanded ``(py_tag, abi_tag, platform)`` tags the file supports
+        """
+        return [(py_tag, abi_tag, platform)
+                for py_tag in self.py_tag.split(".")
+                for abi_tag in self.abi_tag.split(".")
+                for platform in self.platform.split(".")]
+
+
+def normalize_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_filename(filename, url=None):
+    """
+    :param str filename: A wheel or Windows installer file name
+    :return: Its :class:`WheelFile`, or None if the name is not one of those
+    """
+    match = WHEEL_RGX.match(filename)
+    if match is not None:
+        return WheelFile(url=url, filename=filename, **match.groupdict())
+    match = INSTALLER_RGX.match(filename)
+    if match is None:
+        return None
+    py_version = match.group("py_version")
+    return WheelFile(match.group("name"), match.group("version"), None,
+                     "cp{0}".format(py_version.replace(".", "")) if py_version else "py2.py3", "none",
+                     match.group("platform").replace("-", "_"), filename, url)
+
+
+def compatible_tags(py_version, py_arch):
+    """
+    :param str py_version: A Python version, e.g. ``2.7``
+    :param str py_arch: ``32`` or ``64``
+    :return tuple: The ``(py_tags, platforms)`` a Windows build of that Python accepts
+    """
+    major, _, minor = py_version.partition(".")
+    py_tags = ["cp{0}{1}".format(major, minor), "py{0}{1}".format(major, minor), "py{0}".format(major)]
+    return py_tags, [ARCH_PLATFORMS[str(py_arch)], "any"]
+
+
+def decode_link(onclick, base_url):
+    """
+    Decode the obfuscated URL of a download link from its ``onclick`` JavaScript call.
+
+    :param str onclick: The ``javascript:dl([...], "...")`` call
+    :return str: The absolute URL of the file, or None if ``onclick`` is not such a call
+    """
+    match = JS_CALL_RGX.match(onclick)
+    if match is None:
+        return None
+    try:
+        char_codes = ast.literal_eval(match.group("char_codes").rstrip(","))
+        decoded_link = "".join(chr(char_codes[ord(char) - 48]) for char in match.group("encoded_link"))
+    except (ValueError, SyntaxError, TypeError, IndexError):
+        return None
+    return urlparse.urljoin(base_url, decoded_link)
+
+
+def iter_page_links(element, base_url):
+    """
+    :param element: A parsed Gohlke-style download page
+    :return: An iterator of ``(filename, url)`` for each of its download links; links that cannot be decoded are
+             skipped
+    """
+    for link in element.xpath(LINK_XPATH):
+        url = decode_link(link.get("onclick"), base_url)
+        if url is None:
+            logger.debug("Skipping the undecodable link %r (onclick %r)", link.get("title"), link.get("onclick"))
+            continue
+        yield os.path.basename(urlparse.urlparse(url).path), url
+
+
+class WheelIndex(object):
+    """
+    Distribution files with an SQLite index over their expanded tags.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, name TEXT, norm_name TEXT, version TEXT,
+                                              build TEXT, py_tag TEXT, abi_tag TEXT, platform TEXT,
+                                              filename TEXT, url TEXT);
+            CREATE TABLE IF NOT EXISTS tags (file_id INTEGER, py_tag TEXT, abi_tag TEXT, platform TEXT);
+            CREATE INDEX IF NOT EXISTS files_name ON files (norm_name);
+            CREATE INDEX IF NOT EXISTS tags_py_platform ON tags (py_tag, platform);
+            CREATE INDEX IF NOT EXISTS tags_platform ON tags (platform);
+            CREATE INDEX IF NOT EXISTS tags_file ON tags (file_id);
+        """)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+    @classmethod
+    def from_links(cls, links, path=":memory:"):
+        """
+        :param links: An iterable of ``(filename, url)``; names that do not parse are skipped
+        """
+        index = cls(path)
+        index.add_all(parse_filename(filename, url) for filename, url in links)
+        return index
+
+    def add_all(self, wheel_files):
+        with self.conn:
+            for wheel_file in wheel_files:
+                if wheel_file is None:
+                    continue
+                cursor = self.conn.execute("INSERT INTO files VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                           (wheel_file.name, normalize_name(wheel_file.name)) + wheel_file[1:])
+                self.conn.executemany("INSERT INTO tags VALUES (?, ?, ?, ?)",
+                                      [(cursor.lastrowid,) + tag for tag in wheel_file.tags])
+
+    def find(self, name=None, py_tags=None, abi_tags=None, platforms=None):
+        """
+        Look up the files matching every given criterion; each of the tag criteria is a list of accepted values.
+
+        :return list: The matching :class:`WheelFile`, in insertion order
+        """
+        clauses, params = [], []
+        if name is not None:
+            clauses.append("f.norm_name = ?")
+            params.append(normalize_name(name))
+        for column, values in (("py_tag", py_tags), ("abi_tag", abi_tags), ("platform", platforms)):
+            if values:
+                clauses.append("t.{0} IN ({1})".format(column, ", ".join("?" * len(values))))
+                params.extend(values)
+        sql = ("SELECT DISTINCT f.id, f.name, f.version, f.build, f.py_tag, f.abi_tag, f.platform, f.filename, f.url "
+               "FROM files f JOIN tags t ON t.file_id = f.id")
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return [WheelFile(*row[1:]) for row in self.conn.execute(sql + " ORDER BY f.id", params)]
+
+    def find_compatible(self, py_version, py_arch, name=None):
+        py_tags, platforms = compatible_tags(py_version, py_arch)
+        return self.find(name, py_tags=py_tags, platforms=platforms)
+
+    def newest_compatible(self, py_version, py_arch):
+        """
+        :return dict: A mapping of each package name to its newest :class:`WheelFile` compatible with the given
+                      Python version and architecture
+        """
+        newest = {}
+        for wheel_file in self.find_compatible(py_version, py_arch):
+            current = newest.get(wheel_file.name)
+            if current is None or LooseVersion(wheel_file.version) > LooseVersion(current.version):
+                newest[wheel_file.name] = wheel_file
+        return newest
+
+    def newest_by_py_tag(self, name, platforms=None):
+        """
+        :return dict: A mapping of each (expanded) Python tag to the newest :class:`WheelFile` of ``name`` for it
+        """
+        newest = {}
+        for wheel_file in self.find(name, platforms=platforms):
+            for py_tag in wheel_file.py_tag.split("."):
+                current = newest.get(py_tag)
+                if current is None or LooseVersion(wheel_file.version) > LooseVersion(current.version):
+                    newest[py_tag] = wheel_file
+        return newest
+
+
+def load_page_index(cached_page, session=None, force=False, index_name="wheel_index.db"):
+    """
+    Revalidate a :class:`disk_cache.CachedPage` download page and return the index of its links. The index is
+    stored next to the page, so an unchanged page is neither downloaded nor parsed again. When the page cannot be
+    revalidated, the copy on disk is used.
+
+    :param bool force: True to download the page and rebuild the index unconditionally
+    :return: The :class:`WheelIndex` of the page
+    """
+    try:
+        cached_page.refresh(session, force=force)
+    except requests.RequestException as e:
+        if not cached_page.content_path.exists():
+            raise
+        logger.warning("Unable to revalidate %s, using the cached copy: %s", cached_page.url, e)
+    index_path = cached_page.derived_path(index_name)
+    if not index_path.exists():
+        tree = etree.fromstring(cached_page.content(), HTMLParser())
+        tmp_path = index_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        index = WheelIndex.from_links(iter_page_links(tree, cached_page.meta.get("url") or cached_page.url), tmp_path)
+        logger.info("Indexed %d files from %s", len(index), cached_page.url)
+        index.close()
+        os.rename(tmp_path, index_path)
+    return WheelIndex(index_path)